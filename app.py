@@ -3,24 +3,61 @@
 支持 AI 报告生成、Python 自动画图、PDF 提取、历史记录
 """
 
+import io
 import os
+import re
+import sys
+import mmap
 import uuid
+import codecs
 import shutil
+import hashlib
+import stat
+import tempfile
+import logging
 import subprocess
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from logging.handlers import RotatingFileHandler
+from urllib.parse import unquote
+from flask import Flask, Response, render_template, request, jsonify, send_file, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.utils import secure_filename
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 import config
 from utils.latex_compiler import compile_latex, LaTeXCompiler
 from utils.template_processor import TemplateProcessor
-from utils.report_generator import create_generator, OpenAIBackend, ReportGenerator
-from utils.pdf_extractor import extract_text_from_pdf, extract_guide_content
-from utils.python_executor import PythonExecutor, extract_python_code_from_ai_response, generate_figure_latex
+from utils.report_generator import create_generator, get_openai_backend, ReportGenerator
+from utils.pdf_extractor import extract_text_from_pdf, extract_guide_content, condense_guide_text
+from utils.python_executor import PythonExecutor, extract_python_code_from_ai_response, generate_figure_latex, prestart_plot_worker
 from utils.history_manager import HistoryManager
+from utils.state_store import create_store, MemoryStore, StoreNamespace
+
+class OrjsonProvider(DefaultJSONProvider):
+    """使用 orjson 编解码请求与响应中的 JSON（C 实现，速度明显快于标准库 json）"""
+    
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        # orjson 不支持的类型（如 Decimal）交给 Flask 默认的转换函数处理
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 # 创建 Flask 应用
 app = Flask(__name__)
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = config.SECRET_KEY
 app.config['MAX_CONTENT_LENGTH'] = config.MAX_CONTENT_LENGTH
 app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
@@ -29,8 +66,16 @@ app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
 os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(config.OUTPUT_FOLDER, exist_ok=True)
 
+# 会话与任务状态存储（配置 REDIS_URL 时使用 Redis，否则保存在进程内存中），记录超过有效期后自动清除
+state_store = create_store(config.REDIS_URL, ttl=config.STATE_TTL, max_entries=config.SESSION_MAX_ENTRIES)
+# 进程内存储按记录数淘汰，任务使用单独的存储，避免任务记录挤掉会话；Redis 不按数量淘汰，两者共用
+if isinstance(state_store, MemoryStore):
+    task_store = MemoryStore(ttl=config.STATE_TTL, max_entries=config.TASK_MAX_ENTRIES)
+else:
+    task_store = state_store
+
 # 存储会话数据
-sessions = {}
+sessions = StoreNamespace(state_store, 'session:')
 
 # API 配置（运行时）
 api_config = {
@@ -39,17 +84,131 @@ api_config = {
     'model': 'gpt-4o'
 }
 
+# 流式上传时每次读写的分块大小
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# 复制文件时的缓冲区大小
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# 准备工作目录时并发复制文件的线程数
+FILE_STAGING_WORKERS = 8
+
+# 读写 .tex 文件的缓冲区大小（报告通常为几十到几百 KB，一两次系统调用即可读写完）
+TEXT_IO_BUFFER_SIZE = 1 << 20
+
+# 报告 LaTeX 模板（TemplateProcessor 按修改时间缓存文件内容，修改模板后无需重启）
+TEMPLATE_PATH = os.path.join(config.TEMPLATE_FOLDER, 'template.tex')
+
 # 历史记录管理器
 history_manager = HistoryManager(config.OUTPUT_FOLDER)
 
-def log_debug(message):
-    """记录调试信息到文件"""
-    log_file = os.path.join(config.OUTPUT_FOLDER, "debug.log")
-    with open(log_file, "a", encoding="utf-8") as f:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        f.write(f"[{timestamp}] {message}\n")
+# 调试日志：保持文件句柄常开，超过 10MB 自动轮转
+# （不使用 'app' 作为名称，避免与 Flask 的 app.logger 共用同一个 logger）
+logger = logging.getLogger('physreport')
+if not logger.handlers:
+    _log_handler = RotatingFileHandler(
+        os.path.join(config.OUTPUT_FOLDER, "debug.log"),
+        maxBytes=10 * 1024 * 1024, backupCount=3, encoding="utf-8"
+    )
+    _log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S'))
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+logger.debug("服务器启动/重启")
+
+
+def _fast_copy(src, dst):
+    """
+    复制文件内容（不复制元数据）
+    
+    Linux 下使用 os.sendfile 在内核中直接拷贝，其他平台使用大缓冲区分块复制。
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if sys.platform.startswith('linux'):
+            size = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return dst
+            except OSError:
+                if offset:
+                    raise
+                # 部分文件系统不支持 sendfile，回退到普通复制
+        shutil.copyfileobj(fsrc, fdst, length=COPY_BUFFER_SIZE)
+    return dst
+
+
+def _read_text(path):
+    """读取整个文本文件"""
+    with open(path, 'r', encoding='utf-8', buffering=TEXT_IO_BUFFER_SIZE) as f:
+        return f.read()
+
+
+def _read_text_head(path, max_chars):
+    """
+    读取文本文件开头的 max_chars 个字符
+    
+    通过 mmap 只访问开头至多 4 * max_chars 字节（UTF-8 每个字符最多 4 字节）并只解码这一段，
+    不读入整个文件。增量解码器会丢弃被截断的最后一个多字节字符，其余内容仍按严格模式解码；
+    换行符与文本模式读取时一样统一为 \\n。
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            head = mm[:4 * max_chars]
+    text = codecs.getincrementaldecoder('utf-8')().decode(head)
+    return text.replace('\r\n', '\n').replace('\r', '\n')[:max_chars]
+
+
+# 进程的 umask（os.umask 只能先设置再恢复，不是线程安全的，因此在导入时读取一次）
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _write_text(path, content):
+    """
+    写入文本文件
+    
+    先写入同目录下的临时文件再用 os.replace 原子替换：编译器或并发的请求
+    读到的要么是旧文件、要么是完整的新文件，不会读到写了一半的内容。
+    mkstemp 创建的文件权限为 0600，替换前改为原文件的权限（不存在时按 umask 的默认权限）
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', buffering=TEXT_IO_BUFFER_SIZE) as f:
+            f.write(content)
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
-log_debug("服务器启动/重启")
+
+def _tex_hash(content):
+    """LaTeX 源码的摘要，记录在会话中，用于判断内容自上次成功编译后是否改变"""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _stage_file(src, dst):
+    """复制输入文件到工作目录，源文件不存在时记录警告并返回 None"""
+    try:
+        return _fast_copy(src, dst)
+    except FileNotFoundError:
+        logger.warning(f"输入文件不存在，已跳过: {src}")
+        return None
 
 
 def allowed_file(filename, extensions=None):
@@ -92,9 +251,50 @@ def save_config():
     })
 
 
+# 会话 ID 格式（服务端生成的是 UUID），会话 ID 会用作目录名，不符合格式的一律拒绝
+SESSION_ID_RE = re.compile(r'\A[A-Za-z0-9_-]{1,64}\Z')
+
+
+def _valid_session_id(session_id):
+    return bool(SESSION_ID_RE.match(session_id))
+
+
+@app.before_request
+def validate_session_id():
+    """路径中带会话 ID 的接口先检查格式，再查询会话与历史记录"""
+    session_id = (request.view_args or {}).get('session_id')
+    if session_id is not None and not _valid_session_id(session_id):
+        return jsonify({'success': False, 'message': '无效的会话 ID'}), 400
+
+
+# 上传文件类型，类型名会成为保存文件名的一部分，不在列表中的一律拒绝
+UPLOAD_TYPES = frozenset({'guide', 'data_sheet', 'preview_report', 'other'})
+
+
+def _new_upload_path(session_id, file_type, original_name):
+    """为上传文件生成安全的保存路径，返回 (保存文件名, 完整路径)"""
+    session_dir = os.path.join(config.UPLOAD_FOLDER, session_id)
+    os.makedirs(session_dir, exist_ok=True)
+    
+    # 使用 UUID 生成安全的文件名，保留原始扩展名
+    ext = os.path.splitext(original_name)[1].lower()
+    safe_name = str(uuid.uuid4())
+    filename = f"{file_type}_{safe_name}_{datetime.now().strftime('%H%M%S')}{ext}"
+    return filename, os.path.join(session_dir, filename)
+
+
+def _register_uploads(session_id, file_type, uploaded_files):
+    """将上传的文件记录到会话数据中（原子操作，同一会话的并发上传不会互相覆盖）"""
+    def add_files(session):
+        session.setdefault('files', {}).setdefault(file_type, []).extend(uploaded_files)
+        return session
+    
+    sessions.modify(session_id, add_files)
+
+
 @app.route('/api/upload', methods=['POST'])
 def upload_files():
-    """上传文件"""
+    """上传文件（multipart 表单，适合小文件）"""
     if 'files' not in request.files:
         return jsonify({'success': False, 'message': '没有文件上传'}), 400
     
@@ -102,27 +302,22 @@ def upload_files():
     file_type = request.form.get('type', 'other')  # guide, data_sheet, preview_report
     session_id = request.form.get('session_id')
     
+    if file_type not in UPLOAD_TYPES:
+        return jsonify({'success': False, 'message': '无效的上传类型'}), 400
+    
     if not session_id:
         session_id = str(uuid.uuid4())
-    
-    # 创建会话目录
-    session_dir = os.path.join(config.UPLOAD_FOLDER, session_id)
-    os.makedirs(session_dir, exist_ok=True)
+    elif not _valid_session_id(session_id):
+        return jsonify({'success': False, 'message': '无效的会话 ID'}), 400
     
     uploaded_files = []
     for file in files:
         if file and file.filename and allowed_file(file.filename):
-            # 获取原始扩展名
-            ext = os.path.splitext(file.filename)[1].lower()
-            if not ext:
-                # 如果没有扩展名 (虽然 allowed_file 应该过滤了)，尝试从 secure_filename 获取
-                # 或者直接跳过
+            if not os.path.splitext(file.filename)[1]:
+                # 如果没有扩展名 (虽然 allowed_file 应该过滤了)，直接跳过
                 continue
 
-            # 使用 UUID 生成安全的文件名，保留原始扩展名
-            safe_name = str(uuid.uuid4())
-            filename = f"{file_type}_{safe_name}_{datetime.now().strftime('%H%M%S')}{ext}"
-            filepath = os.path.join(session_dir, filename)
+            filename, filepath = _new_upload_path(session_id, file_type, file.filename)
             
             file.save(filepath)
             uploaded_files.append({
@@ -133,12 +328,7 @@ def upload_files():
             })
     
     # 更新会话数据
-    if session_id not in sessions:
-        sessions[session_id] = {'files': {}}
-    
-    if file_type not in sessions[session_id]['files']:
-        sessions[session_id]['files'][file_type] = []
-    sessions[session_id]['files'][file_type].extend(uploaded_files)
+    _register_uploads(session_id, file_type, uploaded_files)
     
     return jsonify({
         'success': True,
@@ -147,60 +337,152 @@ def upload_files():
     })
 
 
+@app.route('/api/upload-stream', methods=['POST'])
+def upload_stream():
+    """
+    流式上传单个文件
+    
+    请求体即文件原始内容，直接分块写入磁盘，不经过 multipart 解析，
+    大文件上传时内存占用保持在一个分块大小左右。
+    文件名、类型和会话 ID 通过 X-Filename / X-Type / X-Session-Id 请求头
+    （或同名查询参数 filename / type / session_id）传递，文件名需 URL 编码。
+    """
+    filename = unquote(request.headers.get('X-Filename') or request.args.get('filename', ''))
+    file_type = request.headers.get('X-Type') or request.args.get('type', 'other')
+    session_id = request.headers.get('X-Session-Id') or request.args.get('session_id')
+    
+    if not filename or not allowed_file(filename):
+        return jsonify({'success': False, 'message': '不支持的文件类型'}), 400
+    
+    if file_type not in UPLOAD_TYPES:
+        return jsonify({'success': False, 'message': '无效的上传类型'}), 400
+    
+    if not session_id:
+        session_id = str(uuid.uuid4())
+    elif not _valid_session_id(session_id):
+        return jsonify({'success': False, 'message': '无效的会话 ID'}), 400
+    
+    saved_name, filepath = _new_upload_path(session_id, file_type, filename)
+    
+    try:
+        with open(filepath, 'wb') as out:
+            shutil.copyfileobj(request.stream, out, length=UPLOAD_CHUNK_SIZE)
+    except BaseException:
+        # 客户端断开或请求体超过 MAX_CONTENT_LENGTH 时删除写了一半的文件
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+        raise
+    
+    uploaded = {
+        'name': filename,
+        'saved_name': saved_name,
+        'path': filepath,
+        'type': file_type
+    }
+    _register_uploads(session_id, file_type, [uploaded])
+    
+    return jsonify({
+        'success': True,
+        'session_id': session_id,
+        'files': [uploaded]
+    })
+
+
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # =====================================================
-# 任务管理器 (简单内存版)
+# 任务管理器（状态保存在 task_store 中）
 # =====================================================
 
 class TaskManager:
-    def __init__(self):
-        self.tasks = {}
+    def __init__(self, store):
+        self.store = store
+        self.tasks = StoreNamespace(store, 'task:')
         self.lock = threading.Lock()
     
+    # 锁内只做存储读写，ID、时间戳与字段字典都在加锁前准备好
     def create_task(self):
         task_id = str(uuid.uuid4())
+        task = {
+            'id': task_id,
+            'status': 'pending', # pending, processing, completed, failed
+            'progress': 0,
+            'message': '任务已创建',
+            'result': None,
+            'error': None,
+            'created_at': datetime.now().isoformat()
+        }
         with self.lock:
-            self.tasks[task_id] = {
-                'id': task_id,
-                'status': 'pending', # pending, processing, completed, failed
-                'progress': 0,
-                'message': '任务已创建',
-                'result': None,
-                'error': None,
-                'created_at': datetime.now()
-            }
+            self.tasks.set(task_id, task)
         return task_id
     
-    def update_progress(self, task_id, progress, message=None):
+    def _update_existing(self, task_id, fields):
         with self.lock:
-            if task_id in self.tasks:
-                self.tasks[task_id]['progress'] = progress
-                self.tasks[task_id]['status'] = 'processing'
-                if message:
-                    self.tasks[task_id]['message'] = message
+            if task_id not in self.tasks:
+                return
+            self.tasks.update(task_id, fields)
+        # 通知正在推送该任务进度的连接
+        self.store.publish('task:' + task_id)
+    
+    def update_progress(self, task_id, progress, message=None):
+        fields = {'progress': progress, 'status': 'processing'}
+        if message:
+            fields['message'] = message
+        self._update_existing(task_id, fields)
     
     def complete_task(self, task_id, result):
-        with self.lock:
-            if task_id in self.tasks:
-                self.tasks[task_id]['status'] = 'completed'
-                self.tasks[task_id]['progress'] = 100
-                self.tasks[task_id]['message'] = '任务完成'
-                self.tasks[task_id]['result'] = result
+        self._update_existing(task_id, {
+            'status': 'completed',
+            'progress': 100,
+            'message': '任务完成',
+            'result': result
+        })
     
-    def fail_task(self, task_id, error):
-        with self.lock:
-            if task_id in self.tasks:
-                self.tasks[task_id]['status'] = 'failed'
-                self.tasks[task_id]['message'] = str(error)
-                self.tasks[task_id]['error'] = str(error)
+    def fail_task(self, task_id, error, result=None):
+        """标记任务失败；result 可附带供前端展示的数据（如当前的 LaTeX 内容）"""
+        error_text = str(error)
+        fields = {
+            'status': 'failed',
+            'message': error_text,
+            'error': error_text
+        }
+        if result is not None:
+            fields['result'] = result
+        self._update_existing(task_id, fields)
                 
     def get_task(self, task_id):
         with self.lock:
             return self.tasks.get(task_id)
+    
+    def subscribe(self, task_id):
+        """订阅任务状态变更，返回的对象提供 wait(timeout) 与 close()"""
+        return self.store.subscribe('task:' + task_id)
+
+task_manager = TaskManager(task_store)
+
+# 同时运行的生成任务数上限，超出的任务排队等待空闲槽位
+task_slots = threading.BoundedSemaphore(config.MAX_CONCURRENT_TASKS)
 
-task_manager = TaskManager()
+
+def start_background_task(target, task_id, *args):
+    """在后台线程中运行任务 target(task_id, *args)，并发数受 task_slots 限制"""
+    def runner():
+        # 没有空闲名额时先把任务标记为排队中，前端能看到任务在等待而不是停在初始化提示
+        if not task_slots.acquire(blocking=False):
+            task_manager.update_progress(task_id, 0, "排队等待中…")
+            task_slots.acquire()
+        try:
+            target(task_id, *args)
+        finally:
+            task_slots.release()
+    
+    thread = threading.Thread(target=runner, daemon=True)
+    thread.start()
+    return thread
 
 def run_generation_task(task_id, session_id, student_info, experiment_info, additional_requirements, 
                        files_context, api_settings):
@@ -208,56 +490,61 @@ def run_generation_task(task_id, session_id, student_info, experiment_info, addi
     try:
         task_manager.update_progress(task_id, 5, "正在初始化工作环境...")
         
+        # 画图进程在后台导入 matplotlib 等库，等 AI 返回数据时已可直接使用
+        prestart_plot_worker()
+        
+        # 先加载模板，模板缺失时在调用 AI 之前就结束任务
+        processor = TemplateProcessor(TEMPLATE_PATH)
+        if not processor.template_content:
+            task_manager.fail_task(task_id, f"找不到 LaTeX 模板: {TEMPLATE_PATH}")
+            return
+        
         # 1. 准备工作目录
         work_dir = os.path.join(config.OUTPUT_FOLDER, session_id)
         os.makedirs(work_dir, exist_ok=True)
         fig_dir = os.path.join(work_dir, 'Fig')
         os.makedirs(fig_dir, exist_ok=True)
         
-        # 2. 复制模板和字体
+        # 2. 复制上传的图片（模板已在开始时加载，字体由编译器按需放入工作目录，画图脚本直接读取字体目录）
         task_manager.update_progress(task_id, 10, "正在准备模板文件...")
-        template_src = os.path.join(config.TEMPLATE_FOLDER, 'template.tex')
         template_dst = os.path.join(work_dir, 'main.tex')
-        shutil.copy2(template_src, template_dst)
         
-        # 复制字体
-        for font_file in os.listdir(config.FONTS_FOLDER):
-            if font_file.endswith('.ttf'):
-                shutil.copy2(
-                    os.path.join(config.FONTS_FOLDER, font_file),
-                    os.path.join(work_dir, font_file)
-                )
-
-        # 3. 处理输入文件
-        task_manager.update_progress(task_id, 15, "正在处理上传文件...")
-        guide_text = None
-        data_sheet_images = []
-        preview_report_images = []
+        # 文件路径来自上传接口，直接复制，不预先检查是否存在；丢失的文件在复制时跳过
+        data_sheet_jobs = [(p, os.path.join(work_dir, os.path.basename(p))) for p in files_context.get('data_sheets', [])]
+        preview_jobs = [(p, os.path.join(work_dir, os.path.basename(p))) for p in files_context.get('previews', [])]
         
-        # 处理实验指导书 PDF
-        if files_context.get('guide_path') and os.path.exists(files_context['guide_path']):
-            print(f"DEBUG: 正在处理指导书: {files_context['guide_path']}")
-            task_manager.update_progress(task_id, 20, "正在从指导书中提取文本...")
-            guide_content = extract_guide_content(files_context['guide_path'])
-            if guide_content and guide_content.get('full_text'):
-                guide_text = guide_content['full_text'][:32768] # 再次增加限制到 32k
-                print(f"DEBUG: 提取成功，文本长度: {len(guide_text)}")
+        # 各文件的复制相互独立，并发执行，同时在当前线程处理指导书
+        with ThreadPoolExecutor(max_workers=FILE_STAGING_WORKERS) as pool:
+            data_sheet_futures = [pool.submit(_stage_file, src, dst) for src, dst in data_sheet_jobs]
+            preview_futures = [pool.submit(_stage_file, src, dst) for src, dst in preview_jobs]
+            
+            # 3. 处理输入文件
+            task_manager.update_progress(task_id, 15, "正在处理上传文件...")
+            guide_text = None
+            
+            # 处理实验指导书 PDF
+            # 文件无法读取时 extract_guide_content 返回空字典
+            if files_context.get('guide_path'):
+                print(f"DEBUG: 正在处理指导书: {files_context['guide_path']}")
+                task_manager.update_progress(task_id, 20, "正在从指导书中提取文本...")
+                guide_content = extract_guide_content(files_context['guide_path'], cache_dir=config.PDF_CACHE_FOLDER)
+                if guide_content and guide_content.get('full_text'):
+                    # 去掉页眉页脚等重复内容，并按 token 数限制长度
+                    guide_text = condense_guide_text(
+                        guide_content['full_text'],
+                        max_tokens=config.GUIDE_MAX_TOKENS,
+                        max_chars=config.GUIDE_MAX_CHARS,
+                        model=api_settings['model']
+                    )
+                    print(f"DEBUG: 提取成功，文本长度: {len(guide_text)}")
+                else:
+                    print(f"DEBUG: 提取失败或内容为空")
             else:
-                print(f"DEBUG: 提取失败或内容为空")
-        else:
-            print(f"DEBUG: 跳过指导书提取，路径: {files_context.get('guide_path')}")        
-        # 复制图片并收集路径
-        for img_path in files_context.get('data_sheets', []):
-            if os.path.exists(img_path):
-                filename = os.path.basename(img_path)
-                shutil.copy2(img_path, os.path.join(work_dir, filename))
-                data_sheet_images.append(os.path.join(work_dir, filename))
-                
-        for img_path in files_context.get('previews', []):
-            if os.path.exists(img_path):
-                filename = os.path.basename(img_path)
-                shutil.copy2(img_path, os.path.join(work_dir, filename))
-                preview_report_images.append(os.path.join(work_dir, filename))
+                print(f"DEBUG: 跳过指导书提取，路径: {files_context.get('guide_path')}")
+            
+            # 等待复制完成（除文件丢失外的复制错误在此抛出），只保留复制成功的图片
+            data_sheet_images = [dst for dst in (f.result() for f in data_sheet_futures) if dst]
+            preview_report_images = [dst for dst in (f.result() for f in preview_futures) if dst]
 
         # 4. AI 生成内容
         task_manager.update_progress(task_id, 30, "AI 正在分析数据并生成报告内容 (Step 1/3)...")
@@ -266,48 +553,57 @@ def run_generation_task(task_id, session_id, student_info, experiment_info, addi
         generated_figures = []
         
         if api_settings['url'] and api_settings['key']:
-            backend = OpenAIBackend(
-                api_key=api_settings['key'],
-                api_url=api_settings['url'],
-                model=api_settings['model']
-            )
+            backend = get_openai_backend(api_settings['url'], api_settings['key'], api_settings['model'])
             generator = ReportGenerator(backend)
             
-            # 生成 LaTeX 内容
-            latex_content = generator.generate_report_content(
-                experiment_guide=guide_text,
-                data_sheet_images=data_sheet_images,
-                additional_requirements=additional_requirements
-            )
+            # 画图代码只依赖数据表格：数据处理部分生成后立即在后台请求，与第 3 步并行
+            plot_pool = ThreadPoolExecutor(max_workers=1)
+            plot_future = None
             
-            # 生成图表
-            log_debug(f"Step: 开始生成图表, session_id: {session_id}")
-            task_manager.update_progress(task_id, 70, "AI 正在生成画图代码...")
-            plot_prompt = build_plotting_prompt(
-                experiment_info['experiment_name'],
-                latex_content
-            )
+            def request_plot_code(tables_content):
+                nonlocal plot_future
+                logger.debug(f"Step: 开始生成图表, session_id: {session_id}")
+                task_manager.update_progress(task_id, 60, "AI 正在生成分析总结和画图代码 (Step 3/3)...")
+                plot_prompt = build_plotting_prompt(
+                    experiment_info['experiment_name'],
+                    tables_content
+                )
+                plot_future = plot_pool.submit(generator.backend.generate, plot_prompt, data_sheet_images[:2])
             
-            plot_response = generator.backend.generate(plot_prompt, data_sheet_images[:2])
-            log_debug(f"AI Plot Response: {plot_response[:500]}...") # 只记录开头
+            try:
+                # 生成 LaTeX 内容
+                latex_content = generator.generate_report_content(
+                    experiment_guide=guide_text,
+                    data_sheet_images=data_sheet_images,
+                    additional_requirements=additional_requirements,
+                    on_data_ready=request_plot_code
+                )
+                
+                # 生成图表
+                task_manager.update_progress(task_id, 70, "AI 正在生成画图代码...")
+                if plot_future is None:
+                    request_plot_code(latex_content)
+                plot_response = plot_future.result()
+            finally:
+                plot_pool.shutdown(wait=False, cancel_futures=True)
+            logger.debug(f"AI Plot Response: {plot_response[:500]}...") # 只记录开头
             
             python_data_code, python_plot_code = extract_python_code_from_ai_response(plot_response)
-            log_debug(f"Extracted data_code: {bool(python_data_code)}, plot_code: {bool(python_plot_code)}")
+            logger.debug(f"Extracted data_code: {bool(python_data_code)}, plot_code: {bool(python_plot_code)}")
             
             if python_plot_code:
                 task_manager.update_progress(task_id, 80, "正在执行 Python 作图...")
-                executor = PythonExecutor(work_dir)
+                executor = PythonExecutor(work_dir, config.FONTS_FOLDER)
                 success, msg, generated_figures = executor.execute_plotting_code(
                     python_plot_code, 
                     python_data_code
                 )
-                log_debug(f"Plot Execution: success={success}, msg={msg}, figures={len(generated_figures)}")
+                logger.debug(f"Plot Execution: success={success}, msg={msg}, figures={len(generated_figures)}")
             else:
-                log_debug("未提取到 Python 画图代码")
+                logger.debug("未提取到 Python 画图代码")
 
         # 5. 整合模板
         task_manager.update_progress(task_id, 85, "正在整合报告内容...")
-        processor = TemplateProcessor(template_dst)
         
         # 处理日期
         date_str = experiment_info['date']
@@ -346,8 +642,7 @@ def run_generation_task(task_id, session_id, student_info, experiment_info, addi
         content = add_appendix_images(content, work_dir, data_sheet_images, preview_report_images)
         
         # 写入文件
-        with open(template_dst, 'w', encoding='utf-8') as f:
-            f.write(content)
+        _write_text(template_dst, content)
             
         # 6. 编译 PDF
         task_manager.update_progress(task_id, 90, "正在编译 PDF...")
@@ -359,11 +654,11 @@ def run_generation_task(task_id, session_id, student_info, experiment_info, addi
         
         if success:
             # 保存会话信息
-            sessions[session_id] = sessions.get(session_id, {})
-            sessions[session_id].update({
+            sessions.update(session_id, {
                 'work_dir': work_dir,
                 'tex_file': template_dst,
-                'pdf_file': pdf_path
+                'pdf_file': pdf_path,
+                'tex_hash': _tex_hash(content)
             })
             
             # 添加历史记录
@@ -439,8 +734,9 @@ def generate_report():
         'previews': []
     }
     
-    if session_id in sessions and 'files' in sessions[session_id]:
-        files = sessions[session_id]['files']
+    session = sessions.get(session_id)
+    if session and 'files' in session:
+        files = session['files']
         # 指导书
         if 'guide' in files:
             for f in files['guide']:
@@ -457,20 +753,16 @@ def generate_report():
     # 创建并启动任务
     task_id = task_manager.create_task()
     
-    thread = threading.Thread(
-        target=run_generation_task,
-        args=(
-            task_id, 
-            session_id, 
-            student_info, 
-            experiment_info, 
-            additional_requirements,
-            files_context,
-            api_settings
-        )
+    start_background_task(
+        run_generation_task,
+        task_id, 
+        session_id, 
+        student_info, 
+        experiment_info, 
+        additional_requirements,
+        files_context,
+        api_settings
     )
-    thread.daemon = True
-    thread.start()
     
     return jsonify({
         'success': True,
@@ -492,6 +784,43 @@ def get_task_status(task_id):
     })
 
 
+# 任务进度推送的心跳间隔（秒），防止空闲连接被代理或浏览器断开
+TASK_STREAM_KEEPALIVE = 15
+
+
+@app.route('/api/task/<task_id>/stream')
+def stream_task_status(task_id):
+    """以 Server-Sent Events 推送任务状态，任务结束后关闭连接"""
+    if not task_manager.get_task(task_id):
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    
+    def generate():
+        # 先订阅再读取状态，读取之后发生的变更都会触发通知
+        subscription = task_manager.subscribe(task_id)
+        try:
+            last_task = None
+            while True:
+                task = task_manager.get_task(task_id)
+                if task is None:
+                    payload = {'success': False, 'message': '任务不存在'}
+                    yield f"data: {app.json.dumps(payload)}\n\n"
+                    return
+                if task != last_task:
+                    yield f"data: {app.json.dumps({'success': True, 'task': task})}\n\n"
+                    last_task = task
+                if task['status'] in ('completed', 'failed'):
+                    return
+                if not subscription.wait(timeout=TASK_STREAM_KEEPALIVE):
+                    yield ": keepalive\n\n"
+        finally:
+            subscription.close()
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
 def build_generation_prompt(experiment_name, student_info, experiment_info, additional_requirements, guide_text=None):
     """构建 AI 生成提示"""
     guide_section = ""
@@ -555,26 +884,29 @@ def build_plotting_prompt(experiment_name, latex_content):
 """
 
 
+# 报告内容整合使用的正则（模块加载时编译一次）
+_FIG_RE = re.compile(r'\\begin\{figure\}.*?\\end\{figure\}', re.DOTALL)
+_FIG_HDR_RE = re.compile(r'\\begin\{figure\}\[[^\]]+\]')
+_TABLE_END_RE = re.compile(r'\\end\{table\}')
+_TABLE_HDR_RE = re.compile(r'\\begin\{table\}\[[^\]]+\]')
+_CONTENT_BLOCK_RE = re.compile(r'(% BEGIN:content)(.*?)(% END:content)', re.DOTALL)
+_APPENDIX_BLOCK_RE = re.compile(r'(% BEGIN:appendix)(.*?)(% END:appendix)', re.DOTALL)
+_SECTION_INSERT_RE = re.compile(r'(\\section\{思考题\})|(\\section\{总结\})|(% BEGIN:appendix)')
+
+
 def add_figures_to_content(content, figure_latex_list_str):
     """将生成的图表交替插入到对应的表格后面"""
-    import re
-    
-    # 提取所有的 figure 环境
-    figs = re.findall(r'\\begin\{figure\}.*?\\end\{figure\}', figure_latex_list_str, re.DOTALL)
-    
-    # 将所有 figure 里的 [htbp] 强制改为 [H]
-    figs = [re.sub(r'\\begin\{figure\}\[[^\]]+\]', r'\\begin{figure}[H]', f) for f in figs]
+    # 先把所有 figure 的位置参数（如 [htbp]）统一改为 [H]，再一次性提取所有 figure 环境
+    figs = _FIG_RE.findall(_FIG_HDR_RE.sub(r'\\begin{figure}[H]', figure_latex_list_str))
 
-    # 查找所有的 table 环境的结尾
-    table_pattern = r'(\\end\{table\})'
-    table_matches = list(re.finditer(table_pattern, content))
+    # 所有 table 环境结尾的位置
+    positions = [m.end() for m in _TABLE_END_RE.finditer(content)]
     
-    if not table_matches or not figs:
+    if not positions or not figs:
         # 如果没找到表格或者没图像，回退到原始位置插入
         if figs:
             # 尝试在“思考题”前插入
-            pattern = r'(\\section\{思考题\})|(\\section\{总结\})|(% BEGIN:appendix)'
-            match = re.search(pattern, content)
+            match = _SECTION_INSERT_RE.search(content)
             if match:
                 insert_pos = match.start()
                 figs_text = "\n\n\\subsection{数据分析图表}\n" + "\n\n".join(figs) + "\n"
@@ -582,54 +914,43 @@ def add_figures_to_content(content, figure_latex_list_str):
             return content + "\n\n" + "\n\n".join(figs)
         return content
 
-    # 从后往前插入，避免序号偏移
-    new_content = content
-    # 尽可能一一对应，多出来的图插在最后一个表后面
-    for i in range(len(table_matches) - 1, -1, -1):
-        match = table_matches[i]
-        insert_pos = match.end()
-        
-        # 如果这是最后一个表，且图比表多，把后面所有的图都插在这里
-        if i == len(table_matches) - 1 and len(figs) > len(table_matches):
-            remaining_figs = figs[i:]
-            fig_text = f"\n\n" + "\n\n".join(remaining_figs) + "\n"
-        elif i < len(figs):
-            fig_text = f"\n\n{figs[i]}\n"
-        else:
-            continue
-            
-        new_content = new_content[:insert_pos] + fig_text + new_content[insert_pos:]
-        
-    return new_content
+    # 图与表一一对应；图比表多时，多出来的图都插在最后一个表后面
+    fig_groups = [[fig] for fig in figs[:len(positions)]]
+    fig_groups[-1].extend(figs[len(positions):])
+    
+    # 按顺序一次性拼接，避免每次插入都重建整个字符串
+    buf = io.StringIO()
+    last_pos = 0
+    for insert_pos, group in zip(positions, fig_groups):
+        buf.write(content[last_pos:insert_pos])
+        buf.write("\n\n" + "\n\n".join(group) + "\n")
+        last_pos = insert_pos
+    buf.write(content[last_pos:])
+    
+    return buf.getvalue()
 
 
 def integrate_ai_content(template_content, ai_content):
     """将 AI 生成的内容整合到模板中"""
-    import re
-    
     # AIBackend.clean_content 已经做了基础清理
     # 这里增加一些安全性检查
     ai_content = ai_content.strip()
     
     # 替换内容区块
-    pattern = r'(% BEGIN:content)(.*?)(% END:content)'
-    
     # 使用函数作为 replacement 可以避免复杂的转义问题
     def replacement_func(match):
         return f"{match.group(1)}\n{ai_content}\n{match.group(3)}"
         
     # 如果使用函数，就不需要手动转义反斜杠了，因为 Python 不会解释函数返回值的转义
-    content = re.sub(pattern, replacement_func, template_content, flags=re.DOTALL)
+    content = _CONTENT_BLOCK_RE.sub(replacement_func, template_content)
     
     return content
 
 
 def add_appendix_images(content, work_dir, data_sheet_images, preview_report_images):
     """添加附录图片到报告"""
-    import re
-    
     # 将 AI 生成内容中的所有 table 环境的 [htpb] 替换为 [H]
-    content = re.sub(r'\\begin\{table\}\[[^\]]+\]', r'\\begin{table}[H]', content)
+    content = _TABLE_HDR_RE.sub(r'\\begin{table}[H]', content)
     
     appendix_content = []
     
@@ -658,12 +979,10 @@ def add_appendix_images(content, work_dir, data_sheet_images, preview_report_ima
     if appendix_content:
         appendix_text = '\n'.join(appendix_content)
         # 替换附录区块
-        pattern = r'(% BEGIN:appendix)(.*?)(% END:appendix)'
-        
         def replacement_func(match):
             return f"{match.group(1)}\n\\section{{附录}}\n{appendix_text}\n{match.group(3)}"
             
-        content = re.sub(pattern, replacement_func, content, flags=re.DOTALL)
+        content = _APPENDIX_BLOCK_RE.sub(replacement_func, content)
     
     return content
 
@@ -705,11 +1024,11 @@ def get_history_detail(session_id):
     
     # 恢复会话
     if os.path.exists(record.get('pdf_path', '')):
-        sessions[session_id] = {
+        sessions.set(session_id, {
             'work_dir': record['work_dir'],
             'tex_file': record['tex_path'],
             'pdf_file': record['pdf_path']
-        }
+        })
         
         return jsonify({
             'success': True,
@@ -727,8 +1046,7 @@ def delete_history(session_id):
     success = history_manager.delete_record(session_id)
     
     if success:
-        if session_id in sessions:
-            del sessions[session_id]
+        sessions.delete(session_id)
         return jsonify({'success': True, 'message': '已删除'})
     
     return jsonify({'success': False, 'message': '删除失败'}), 400
@@ -752,19 +1070,53 @@ def search_history():
 # 其他 API
 # =====================================================
 
+def _stat_file(path):
+    """返回文件的 stat 结果，文件不存在时返回 None（一次系统调用同时完成存在性检查）"""
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def send_report_file(path, st, mimetype=None, **kwargs):
+    """
+    发送报告文件（PDF / LaTeX 源码）
+    
+    开启条件请求与分段请求：浏览器重复预览未变化的报告时直接得到 304，
+    PDF 阅读器也可以按 Range 分段读取。传入路径即可：服务器提供 wsgi.file_wrapper 时
+    （如 gunicorn）由 sendfile 直接发送文件内容，否则分块读取发送。
+    max_age=0 要求浏览器每次都向服务器确认，修改报告后不会看到旧文件。
+    st 为调用方检查文件存在时得到的 stat 结果，不再重复 stat。
+    """
+    # ETag 与 Last-Modified 由同一次 stat 得到（纳秒级修改时间，同一秒内重新编译也能区分）
+    # 使用强 ETag：弱 ETag 不能用于 If-Range，PDF 阅读器将无法续传分段
+    return send_file(
+        path,
+        mimetype=mimetype,
+        conditional=True,
+        etag=f"{st.st_size:x}-{st.st_mtime_ns:x}",
+        last_modified=st.st_mtime,
+        max_age=0,
+        **kwargs
+    )
+
+
 @app.route('/api/preview/<session_id>')
 def preview_pdf(session_id):
     """预览 PDF"""
-    if session_id not in sessions or 'pdf_file' not in sessions[session_id]:
+    session = sessions.get(session_id)
+    if not session or 'pdf_file' not in session:
         # 尝试从历史记录恢复
         record = history_manager.get_record(session_id)
-        if record and os.path.exists(record.get('pdf_path', '')):
-            return send_file(record['pdf_path'], mimetype='application/pdf')
+        st = _stat_file(record.get('pdf_path', '')) if record else None
+        if st:
+            return send_report_file(record['pdf_path'], st, mimetype='application/pdf')
         return jsonify({'error': '找不到该报告'}), 404
     
-    pdf_path = sessions[session_id]['pdf_file']
-    if os.path.exists(pdf_path):
-        return send_file(pdf_path, mimetype='application/pdf')
+    pdf_path = session['pdf_file']
+    st = _stat_file(pdf_path)
+    if st:
+        return send_report_file(pdf_path, st, mimetype='application/pdf')
     
     return jsonify({'error': 'PDF 文件不存在'}), 404
 
@@ -772,20 +1124,25 @@ def preview_pdf(session_id):
 @app.route('/api/download/<session_id>')
 def download_pdf(session_id):
     """下载 PDF"""
-    if session_id not in sessions or 'pdf_file' not in sessions[session_id]:
+    session = sessions.get(session_id)
+    if not session or 'pdf_file' not in session:
         record = history_manager.get_record(session_id)
-        if record and os.path.exists(record.get('pdf_path', '')):
-            return send_file(
+        st = _stat_file(record.get('pdf_path', '')) if record else None
+        if st:
+            return send_report_file(
                 record['pdf_path'],
+                st,
                 as_attachment=True,
                 download_name='实验报告.pdf'
             )
         return jsonify({'error': '找不到该报告'}), 404
     
-    pdf_path = sessions[session_id]['pdf_file']
-    if os.path.exists(pdf_path):
-        return send_file(
+    pdf_path = session['pdf_file']
+    st = _stat_file(pdf_path)
+    if st:
+        return send_report_file(
             pdf_path,
+            st,
             as_attachment=True,
             download_name='实验报告.pdf'
         )
@@ -796,20 +1153,25 @@ def download_pdf(session_id):
 @app.route('/api/download-tex/<session_id>')
 def download_tex(session_id):
     """下载 LaTeX 源码"""
-    if session_id not in sessions or 'tex_file' not in sessions[session_id]:
+    session = sessions.get(session_id)
+    if not session or 'tex_file' not in session:
         record = history_manager.get_record(session_id)
-        if record and os.path.exists(record.get('tex_path', '')):
-            return send_file(
+        st = _stat_file(record.get('tex_path', '')) if record else None
+        if st:
+            return send_report_file(
                 record['tex_path'],
+                st,
                 as_attachment=True,
                 download_name='实验报告.tex'
             )
         return jsonify({'error': '找不到该报告'}), 404
     
-    tex_path = sessions[session_id]['tex_file']
-    if os.path.exists(tex_path):
-        return send_file(
+    tex_path = session['tex_file']
+    st = _stat_file(tex_path)
+    if st:
+        return send_report_file(
             tex_path,
+            st,
             as_attachment=True,
             download_name='实验报告.tex'
         )
@@ -817,6 +1179,71 @@ def download_tex(session_id):
     return jsonify({'error': 'LaTeX 文件不存在'}), 404
 
 
+# AI 修改报告时提示中包含的报告内容长度（字符）
+MODIFY_PROMPT_CHARS = 15000
+
+# 流式接收修改结果时，每收到多少字符更新一次任务进度
+MODIFY_PROGRESS_CHARS = 2000
+
+
+def _tex_result(tex_file):
+    """读取当前的 LaTeX 内容作为失败任务的附带结果，读取失败时不附带"""
+    try:
+        return {'tex_content': _read_text(tex_file)}
+    except OSError:
+        return None
+
+
+def run_modify_task(task_id, session_id, tex_file, work_dir, prompt, expected_chars, api_settings):
+    """后台运行的 AI 修改任务：流式接收修改结果，保存后重新编译"""
+    try:
+        task_manager.update_progress(task_id, 10, "正在请求 AI 修改报告...")
+        backend = get_openai_backend(api_settings['url'], api_settings['key'], api_settings['model'])
+        
+        chunks = []
+        received = 0
+        next_report = MODIFY_PROGRESS_CHARS
+        for chunk in backend.generate_stream(prompt):
+            chunks.append(chunk)
+            received += len(chunk)
+            if received >= next_report:
+                next_report = received + MODIFY_PROGRESS_CHARS
+                # 修改后的报告长度与原报告相近，以此估算进度
+                progress = 10 + int(70 * min(1.0, received / max(expected_chars, 1)))
+                task_manager.update_progress(task_id, progress, f"AI 正在修改报告（已接收 {received} 字符）...")
+        
+        modified_content = backend.clean_content(''.join(chunks))
+    except Exception as e:
+        # 文件尚未改动，把当前内容交给前端编辑器，用户可以手动修改
+        task_manager.fail_task(task_id, f'AI 修改失败: {str(e)}', _tex_result(tex_file))
+        return
+    
+    try:
+        # 保存修改后的内容
+        _write_text(tex_file, modified_content)
+        
+        # 重新编译
+        task_manager.update_progress(task_id, 85, "正在重新编译...")
+        success, message, pdf_path = compile_latex(
+            tex_file,
+            work_dir,
+            config.FONTS_FOLDER
+        )
+        
+        if success:
+            sessions.update(session_id, {'pdf_file': pdf_path, 'tex_hash': _tex_hash(modified_content)})
+            task_manager.complete_task(task_id, {
+                'session_id': session_id,
+                'pdf_url': f'/api/preview/{session_id}',
+                'message': '修改成功！'
+            })
+        else:
+            # 修改后的内容已经写入文件，交给前端编辑器，用户可以查看并修正 AI 写出的代码
+            task_manager.fail_task(task_id, f'编译失败: {message}', {'tex_content': modified_content})
+    except Exception as e:
+        task_manager.fail_task(task_id, f'修改失败: {str(e)}', _tex_result(tex_file))
+
+
 @app.route('/api/modify', methods=['POST'])
 def modify_report():
     """修改报告"""
@@ -824,18 +1251,15 @@ def modify_report():
     session_id = data.get('session_id')
     modification = data.get('modification', '')
     
-    if not session_id or session_id not in sessions:
+    session = sessions.get(session_id) if session_id else None
+    if not session:
         return jsonify({'success': False, 'message': '会话不存在'}), 400
     
-    tex_file = sessions[session_id].get('tex_file')
+    tex_file = session.get('tex_file')
     if not tex_file or not os.path.exists(tex_file):
         return jsonify({'success': False, 'message': 'LaTeX 文件不存在'}), 400
     
     try:
-        # 读取当前内容
-        with open(tex_file, 'r', encoding='utf-8') as f:
-            current_content = f.read()
-        
         # 如果有修改要求且有 API 配置，使用 AI 修改
         if modification.strip():
             use_api_url = data.get('api_url') or api_config['url']
@@ -843,18 +1267,13 @@ def modify_report():
             use_api_model = data.get('api_model') or api_config['model']
             
             if use_api_url and use_api_key:
-                try:
-                    backend = OpenAIBackend(
-                        api_key=use_api_key,
-                        api_url=use_api_url,
-                        model=use_api_model
-                    )
-                    
-                    prompt = f"""请根据以下要求修改 LaTeX 实验报告：
+                # 提示中只使用报告开头部分，无需读取整个文件
+                current_head = _read_text_head(tex_file, MODIFY_PROMPT_CHARS)
+                prompt = f"""请根据以下要求修改 LaTeX 实验报告：
 
 ## 当前报告内容：
 ```latex
-{current_content[:15000]}
+{current_head}
 ```
 
 ## 修改要求：
@@ -862,48 +1281,31 @@ def modify_report():
 
 请返回修改后的完整 LaTeX 代码。只返回代码，不要其他说明。
 """
-                    
-                    modified_content_raw = backend.generate(prompt)
-                    modified_content = backend.clean_content(modified_content_raw)
-                    
-                    # 保存修改后的内容
-                    with open(tex_file, 'w', encoding='utf-8') as f:
-                        f.write(modified_content)
-                    
-                    # 重新编译
-                    work_dir = sessions[session_id].get('work_dir')
-                    success, message, pdf_path = compile_latex(
-                        tex_file,
-                        work_dir,
-                        config.FONTS_FOLDER
-                    )
-                    
-                    if success:
-                        sessions[session_id]['pdf_file'] = pdf_path
-                        return jsonify({
-                            'success': True,
-                            'pdf_url': f'/api/preview/{session_id}',
-                            'message': '修改成功！'
-                        })
-                    else:
-                        return jsonify({
-                            'success': False,
-                            'message': f'编译失败: {message}',
-                            'tex_content': modified_content
-                        })
-                        
-                except Exception as e:
-                    return jsonify({
-                        'success': False,
-                        'message': f'AI 修改失败: {str(e)}',
-                        'tex_content': current_content
-                    })
+                
+                # AI 生成与重新编译耗时较长，放到后台任务中执行，前端通过任务接口获取进度
+                task_id = task_manager.create_task()
+                start_background_task(
+                    run_modify_task,
+                    task_id,
+                    session_id,
+                    tex_file,
+                    session.get('work_dir'),
+                    prompt,
+                    len(current_head),
+                    {'url': use_api_url, 'key': use_api_key, 'model': use_api_model}
+                )
+                
+                return jsonify({
+                    'success': True,
+                    'task_id': task_id,
+                    'message': '修改任务已提交'
+                })
         
         # 返回当前内容供手动编辑
         return jsonify({
             'success': True,
             'message': '请在编辑器中手动修改',
-            'tex_content': current_content
+            'tex_content': _read_text(tex_file)
         })
         
     except Exception as e:
@@ -920,19 +1322,29 @@ def update_tex():
     session_id = data.get('session_id')
     tex_content = data.get('tex_content', '')
     
-    if not session_id or session_id not in sessions:
+    session = sessions.get(session_id) if session_id else None
+    if not session:
         return jsonify({'success': False, 'message': '会话不存在'}), 400
     
-    tex_file = sessions[session_id].get('tex_file')
-    work_dir = sessions[session_id].get('work_dir')
+    tex_file = session.get('tex_file')
+    work_dir = session.get('work_dir')
     
     if not tex_file or not work_dir:
         return jsonify({'success': False, 'message': '工作目录不存在'}), 400
     
     try:
         # 保存新内容
-        with open(tex_file, 'w', encoding='utf-8') as f:
-            f.write(tex_content)
+        _write_text(tex_file, tex_content)
+        
+        # 内容与上次成功编译时相同且 PDF 仍在，直接返回现有 PDF
+        tex_hash = _tex_hash(tex_content)
+        pdf_file = session.get('pdf_file')
+        if session.get('tex_hash') == tex_hash and pdf_file and os.path.exists(pdf_file):
+            return jsonify({
+                'success': True,
+                'pdf_url': f'/api/preview/{session_id}',
+                'message': '内容未改变，跳过编译'
+            })
         
         # 重新编译
         success, message, pdf_path = compile_latex(
@@ -942,7 +1354,7 @@ def update_tex():
         )
         
         if success:
-            sessions[session_id]['pdf_file'] = pdf_path
+            sessions.update(session_id, {'pdf_file': pdf_path, 'tex_hash': tex_hash})
             return jsonify({
                 'success': True,
                 'pdf_url': f'/api/preview/{session_id}',
@@ -7,6 +7,7 @@ UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 OUTPUT_FOLDER = os.path.join(BASE_DIR, 'output')
 TEMPLATE_FOLDER = os.path.join(BASE_DIR, 'latex_template')
 FONTS_FOLDER = os.path.join(TEMPLATE_FOLDER, 'fonts')
+PDF_CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, '.pdfcache')  # 指导书提取结果缓存
 
 # 允许的文件类型
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif'}
@@ -16,11 +17,27 @@ ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 XELATEX_PATH = 'xelatex'  # 假设在 PATH 中，否则指定完整路径
 COMPILE_TIMEOUT = 120  # 编译超时时间（秒）
 
+# 任务配置
+MAX_CONCURRENT_TASKS = int(os.getenv('MAX_CONCURRENT_TASKS', '2'))  # 同时运行的报告生成任务数
+
+# 状态存储配置
+# 设置 REDIS_URL（如 redis://localhost:6379/0，需安装 redis 包）后，会话与任务状态保存在 Redis 中，
+# 可由多个服务进程共享且重启后不丢失；留空则保存在进程内存中
+REDIS_URL = os.getenv('REDIS_URL', '')
+STATE_TTL = int(os.getenv('STATE_TTL', str(24 * 3600)))  # 会话与任务状态最后一次写入后的保留时间（秒）
+# 进程内存储中会话与任务分开计数淘汰，大量任务记录不会挤掉仍在使用的会话
+SESSION_MAX_ENTRIES = 4096  # 进程内存储最多保留的会话数
+TASK_MAX_ENTRIES = 4096  # 进程内存储最多保留的任务数
+
 # AI 配置（预留）
 AI_API_URL = os.getenv('AI_API_URL', '')
 AI_API_KEY = os.getenv('AI_API_KEY', '')
 AI_MODEL = os.getenv('AI_MODEL', 'gpt-4')
 
+# 指导书文本发送给 AI 前的长度限制（token 数需安装 tiktoken，否则只按字符数截断）
+GUIDE_MAX_TOKENS = 16000
+GUIDE_MAX_CHARS = 32768
+
 # Flask 配置
 SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
 MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB 最大上传大小
@@ -3,9 +3,10 @@ import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 import os
 
-# 设置中文字体
-plt.rcParams['font.sans-serif'] = ['SimHei', 'SimSun', 'DejaVu Sans']
-plt.rcParams['axes.unicode_minus'] = False
+from utils.python_executor import PLOT_RC_PARAMS
+
+# 设置中文字体（与报告画图脚本使用相同的设置）
+plt.rcParams.update(PLOT_RC_PARAMS)
 
 # 模拟光电探测器实验数据
 V = np.array([0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0])
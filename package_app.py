@@ -8,6 +8,9 @@ import zipfile
 import shutil
 from datetime import datetime
 
+# 本身已压缩的文件格式，直接存储，不再浪费时间压缩
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.pdf', '.zip')
+
 def package_project():
     # 当前目录
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -32,20 +35,22 @@ def package_project():
         'latex_template'
     ]
     
-    # 需要排除的模式
-    excludes = [
+    # 需要排除的文件名与目录名
+    exclude_names = frozenset({
         '__pycache__',
-        '*.pyc',
         '.DS_Store',
         'venv',
         '.git',
         '.idea',
         'uploads',  # 不包含用户数据
         'output'    # 不包含用户数据
-    ]
+    })
+    # 需要排除的文件后缀
+    exclude_suffixes = ('.pyc',)
     
     try:
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        # 最快的压缩级别：打包速度快数倍，体积只略大一些
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
             for item in includes:
                 item_path = os.path.join(current_dir, item)
                 
@@ -59,16 +64,19 @@ def package_project():
                 else:
                     for root, dirs, files in os.walk(item_path):
                         # 排除目录
-                        dirs[:] = [d for d in dirs if d not in excludes and d != '__pycache__']
+                        dirs[:] = [d for d in dirs if d not in exclude_names]
                         
                         for file in files:
                             # 排除文件
-                            if file.endswith('.pyc') or file == '.DS_Store':
+                            if file in exclude_names or file.endswith(exclude_suffixes):
                                 continue
                                 
                             file_path = os.path.join(root, file)
                             arcname = os.path.relpath(file_path, current_dir)
-                            zipf.write(file_path, arcname=arcname)
+                            if file.lower().endswith(STORED_EXTENSIONS):
+                                zipf.write(file_path, arcname=arcname, compress_type=zipfile.ZIP_STORED)
+                            else:
+                                zipf.write(file_path, arcname=arcname)
             
             # 创建空的 uploads 和 output 目录结构
             zipinfo_uploads = zipfile.ZipInfo('uploads/')
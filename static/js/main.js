@@ -205,34 +205,42 @@ function initUploadZones() {
 async function handleFiles(files, type) {
     if (!files || files.length === 0) return;
 
-    const formData = new FormData();
-    formData.append('type', type);
+    showLoading('正在上传文件...');
 
-    if (state.sessionId) {
-        formData.append('session_id', state.sessionId);
-    }
+    let uploadedCount = 0;
 
-    for (const file of files) {
-        formData.append('files', file);
-    }
+    try {
+        // 逐个文件以原始请求体流式上传，避免服务端解析大体积 multipart 表单
+        for (const file of files) {
+            const headers = {
+                'Content-Type': 'application/octet-stream',
+                'X-Filename': encodeURIComponent(file.name),
+                'X-Type': type
+            };
+            if (state.sessionId) {
+                headers['X-Session-Id'] = state.sessionId;
+            }
 
-    showLoading('正在上传文件...');
+            const response = await fetch('/api/upload-stream', {
+                method: 'POST',
+                headers: headers,
+                body: file
+            });
 
-    try {
-        const response = await fetch('/api/upload', {
-            method: 'POST',
-            body: formData
-        });
+            const result = await response.json();
 
-        const result = await response.json();
+            if (!result.success) {
+                showToast(`${file.name}: ${result.message || '上传失败'}`, 'error');
+                continue;
+            }
 
-        if (result.success) {
             state.sessionId = result.session_id;
             state.uploadedFiles[type].push(...result.files);
             updateFileList(type);
+            uploadedCount++;
+        }
+        if (uploadedCount > 0) {
             showToast('文件上传成功', 'success');
-        } else {
-            showToast(result.message || '上传失败', 'error');
         }
     } catch (error) {
         showToast('上传失败: ' + error.message, 'error');
@@ -325,8 +333,8 @@ async function generateReport() {
         const result = await response.json();
 
         if (result.success) {
-            // 开始轮询任务状态
-            pollTaskStatus(result.task_id);
+            // 开始接收任务进度
+            watchTaskStatus(result.task_id);
         } else {
             hideLoading();
             showToast(result.message || '启动失败', 'error');
@@ -341,52 +349,112 @@ async function generateReport() {
     }
 }
 
-async function pollTaskStatus(taskId) {
-    const pollInterval = 2000; // 2秒轮询一次
+// 根据任务状态更新界面，任务结束（成功或失败）时返回 true
+function handleTaskUpdate(task) {
+    // 更新进度显示
+    if (task.message) {
+        document.getElementById('loadingText').textContent = task.message;
+    }
+    if (task.progress) {
+        document.getElementById('loadingSubtext').textContent = `进度: ${task.progress}%`;
+    }
 
-    try {
-        const response = await fetch(`/api/task/${taskId}`);
-        const result = await response.json();
+    if (task.status === 'completed') {
+        hideLoading();
+        state.sessionId = task.result.session_id;
+        showPdfPreview(task.result.pdf_url);
+        enableDownloadButtons();
+        goToStep(3);
+
+        let message = task.result.message || '报告生成成功！';
+        if (task.result.figures_generated > 0) {
+            message += ` 自动生成了 ${task.result.figures_generated} 张图表`;
+        }
+        showToast(message, 'success');
+        return true;
 
+    } else if (task.status === 'failed') {
+        hideLoading();
+        showToast('生成失败: ' + (task.error || '未知错误'), 'error');
+        return true;
+    }
+    return false;
+}
+
+function handleModifyUpdate(task) {
+    if (task.message) {
+        document.getElementById('loadingText').textContent = task.message;
+    }
+    if (task.progress) {
+        document.getElementById('loadingSubtext').textContent = `进度: ${task.progress}%`;
+    }
+
+    if (task.status === 'completed') {
+        hideLoading();
+        showPdfPreview(task.result.pdf_url);
+        showToast(task.result.message || '修改成功', 'success');
+        return true;
+
+    } else if (task.status === 'failed') {
+        hideLoading();
+        showToast(task.error || '修改失败', 'error');
+        // 编辑器载入文件中的当前内容（编译失败时即 AI 写出的代码），便于手动修正
+        if (task.result && task.result.tex_content) {
+            document.getElementById('texEditor').value = task.result.tex_content;
+            openModal('texModal');
+        }
+        return true;
+    }
+    return false;
+}
+
+// 通过 Server-Sent Events 接收任务进度，浏览器不支持或连接出错时退回轮询
+// onUpdate 处理每次状态更新，返回 true 表示任务已结束
+function watchTaskStatus(taskId, onUpdate = handleTaskUpdate) {
+    if (!window.EventSource) {
+        pollTaskStatus(taskId, onUpdate);
+        return;
+    }
+
+    const source = new EventSource(`/api/task/${taskId}/stream`);
+    let finished = false;
+
+    source.onmessage = (event) => {
+        const result = JSON.parse(event.data);
         if (result.success && result.task) {
-            const task = result.task;
+            finished = onUpdate(result.task);
+        } else {
+            finished = onUpdate({ status: 'failed', error: result.message || '任务不存在' });
+        }
+        if (finished) source.close();
+    };
 
-            // 更新进度显示
-            if (task.message) {
-                document.getElementById('loadingText').textContent = task.message;
-            }
-            if (task.progress) {
-                document.getElementById('loadingSubtext').textContent = `进度: ${task.progress}%`;
-            }
+    source.onerror = () => {
+        source.close();
+        if (!finished) pollTaskStatus(taskId, onUpdate);
+    };
+}
 
-            if (task.status === 'completed') {
-                hideLoading();
-                state.sessionId = task.result.session_id;
-                showPdfPreview(task.result.pdf_url);
-                enableDownloadButtons();
-                goToStep(3);
+async function pollTaskStatus(taskId, onUpdate = handleTaskUpdate) {
+    const pollInterval = 2000; // 2秒轮询一次
 
-                let message = task.result.message || '报告生成成功！';
-                if (task.result.figures_generated > 0) {
-                    message += ` 自动生成了 ${task.result.figures_generated} 张图表`;
-                }
-                showToast(message, 'success');
+    try {
+        const response = await fetch(`/api/task/${taskId}`);
+        const result = await response.json();
 
-            } else if (task.status === 'failed') {
-                hideLoading();
-                showToast('生成失败: ' + (task.error || '未知错误'), 'error');
-            } else {
+        if (result.success && result.task) {
+            if (!onUpdate(result.task)) {
                 // 继续轮询
-                setTimeout(() => pollTaskStatus(taskId), pollInterval);
+                setTimeout(() => pollTaskStatus(taskId, onUpdate), pollInterval);
             }
         } else {
             // 任务未找到或请求失败，重试
-            setTimeout(() => pollTaskStatus(taskId), pollInterval);
+            setTimeout(() => pollTaskStatus(taskId, onUpdate), pollInterval);
         }
     } catch (error) {
         console.error('Polling error:', error);
         // 网络错误等，稍微延迟后重试
-        setTimeout(() => pollTaskStatus(taskId), pollInterval + 1000);
+        setTimeout(() => pollTaskStatus(taskId, onUpdate), pollInterval + 1000);
     }
 }
 
@@ -546,6 +614,7 @@ async function modifyReport() {
     }
 
     showLoading('正在处理修改请求...');
+    let waitingForTask = false;
 
     try {
         const response = await fetch('/api/modify', {
@@ -564,7 +633,11 @@ async function modifyReport() {
 
         const result = await response.json();
 
-        if (result.success) {
+        if (result.success && result.task_id) {
+            // AI 修改在后台执行，加载提示由任务结束时关闭
+            waitingForTask = true;
+            watchTaskStatus(result.task_id, handleModifyUpdate);
+        } else if (result.success) {
             if (result.pdf_url) {
                 showPdfPreview(result.pdf_url);
             }
@@ -575,7 +648,7 @@ async function modifyReport() {
     } catch (error) {
         showToast('修改失败: ' + error.message, 'error');
     } finally {
-        hideLoading();
+        if (!waitingForTask) hideLoading();
     }
 }
 
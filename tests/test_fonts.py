@@ -14,19 +14,18 @@ import matplotlib.pyplot as plt
 # 添加父目录到 path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from utils.python_executor import PythonExecutor
+from utils.python_executor import PythonExecutor, PLOT_RC_PARAMS
 from utils.latex_compiler import compile_latex, LaTeXCompiler
 import config
 
+# 与 python_executor 生成的画图脚本使用相同的字体设置
+plt.rcParams.update(PLOT_RC_PARAMS)
+
 def test_python_plot():
     print("Testing Python Plotting...")
     work_dir = os.path.join(config.OUTPUT_FOLDER, 'test_fonts')
     os.makedirs(work_dir, exist_ok=True)
     
-    # 手动配置字体 (模拟 python_executor)
-    plt.rcParams['font.sans-serif'] = ['SimHei', 'Microsoft YaHei', 'DejaVu Sans']
-    plt.rcParams['axes.unicode_minus'] = False
-    
     try:
         x = np.linspace(0, 10, 100)
         y = np.sin(x)
@@ -5,13 +5,50 @@
 
 import os
 import json
+import time
+import threading
+from collections import Counter, OrderedDict
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import shutil
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def _dump_line(entry: Dict) -> bytes:
+    """将一条日志编码为 UTF-8 JSON 行（优先使用 orjson）"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+def _loads(data: bytes):
+    """解析 UTF-8 JSON（格式错误时抛出 ValueError）"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 class HistoryManager:
-    """历史记录管理器"""
+    """
+    历史记录管理器
+    
+    记录以 JSON Lines 追加日志保存（每次增删只追加一行），日志过长时压缩重写；
+    内存中按会话 ID 建立索引
+    """
+    
+    # 最多保留的历史记录数
+    MAX_RECORDS = 100
+    # 日志追加超过该行数后压缩重写
+    COMPACT_THRESHOLD = 200
+    # PDF 是否存在的缓存有效期（秒）
+    EXISTS_TTL = 5.0
+    # 加载与压缩日志时的文件缓冲区大小
+    IO_BUFFER_SIZE = 1 << 20
     
     def __init__(self, base_dir: str):
         """
@@ -21,24 +58,83 @@ class HistoryManager:
             base_dir: 基础目录（通常是 output 目录）
         """
         self.base_dir = base_dir
-        self.history_file = os.path.join(base_dir, 'history.json')
-        self.history = self._load_history()
+        self.log_file = os.path.join(base_dir, 'history.jsonl')
+        # 旧版本使用的整文件 JSON，首次加载时迁移
+        self.legacy_file = os.path.join(base_dir, 'history.json')
+        self.lock = threading.RLock()
+        # 会话 ID -> 记录，按创建顺序排列（最新的在最后），查找、更新、删除与淘汰都是 O(1)
+        self._by_id: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._appended = 0
+        # PDF 路径 -> (检查时间, 是否存在)，列表、搜索、统计共用，避免每次请求逐条 stat
+        self._exists_cache: Dict[str, Tuple[float, bool]] = {}
+        self._load_history()
+    
+    @property
+    def history(self) -> List[Dict]:
+        """全部记录（最新的在前）"""
+        with self.lock:
+            return list(reversed(self._by_id.values()))
     
-    def _load_history(self) -> List[Dict]:
-        """加载历史记录"""
-        if os.path.exists(self.history_file):
+    def _load_history(self):
+        """加载历史记录：重放追加日志，不存在时从旧版 history.json 迁移"""
+        if os.path.exists(self.log_file):
+            with open(self.log_file, 'rb', buffering=self.IO_BUFFER_SIZE) as f:
+                for line in f:
+                    try:
+                        entry = _loads(line)
+                    except ValueError:
+                        continue  # 写入中断留下的不完整行
+                    if entry.get('op') == 'add':
+                        self._by_id[entry['rec']['id']] = entry['rec']
+                    elif entry.get('op') == 'del':
+                        self._by_id.pop(entry.get('id'), None)
+                    self._appended += 1
+            return
+        
+        if os.path.exists(self.legacy_file):
             try:
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with open(self.legacy_file, 'rb') as f:
+                    records = _loads(f.read())
             except:
-                return []
-        return []
+                return
+            for record in reversed(records):
+                self._by_id[record['id']] = record
+            self._compact()
+            os.replace(self.legacy_file, self.legacy_file + '.bak')
+    
+    def _append(self, entry: Dict):
+        """追加一条日志，必要时压缩（调用方需持有锁）"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(self.log_file, 'ab') as f:
+            f.write(_dump_line(entry))
+        self._appended += 1
+        if self._appended > self.COMPACT_THRESHOLD:
+            self._compact()
     
-    def _save_history(self):
-        """保存历史记录"""
+    def _compact(self):
+        """用当前记录重写日志（调用方需持有锁）"""
         os.makedirs(self.base_dir, exist_ok=True)
-        with open(self.history_file, 'w', encoding='utf-8') as f:
-            json.dump(self.history, f, ensure_ascii=False, indent=2)
+        tmp_file = self.log_file + '.tmp'
+        with open(tmp_file, 'wb', buffering=self.IO_BUFFER_SIZE) as f:
+            for record in self._by_id.values():
+                f.write(_dump_line({'op': 'add', 'rec': record}))
+        # 先写临时文件再原子替换，写入中途崩溃不会损坏原日志
+        os.replace(tmp_file, self.log_file)
+        self._appended = len(self._by_id)
+    
+    def _pdf_exists(self, pdf_path: str) -> bool:
+        """PDF 文件是否存在（结果缓存 EXISTS_TTL 秒）"""
+        now = time.monotonic()
+        cached = self._exists_cache.get(pdf_path)
+        if cached and now - cached[0] < self.EXISTS_TTL:
+            return cached[1]
+        exists = os.path.exists(pdf_path)
+        self._exists_cache[pdf_path] = (now, exists)
+        return exists
+    
+    def _forget(self, record: Dict):
+        """记录被替换或删除后，清除其 PDF 的存在性缓存"""
+        self._exists_cache.pop(record.get('pdf_path', ''), None)
     
     def add_record(self, session_id: str, experiment_name: str, 
                    student_name: str, pdf_path: str, tex_path: str,
@@ -68,28 +164,24 @@ class HistoryManager:
             'info': additional_info or {}
         }
         
-        # 检查是否已存在，存在则更新
-        existing_idx = None
-        for i, r in enumerate(self.history):
-            if r['id'] == session_id:
-                existing_idx = i
-                break
-        
-        if existing_idx is not None:
-            record['created_at'] = self.history[existing_idx].get('created_at', record['created_at'])
-            record['updated_at'] = datetime.now().isoformat()
-            self.history[existing_idx] = record
-        else:
-            self.history.insert(0, record)  # 新记录放在开头
-        
-        # 限制历史记录数量
-        if len(self.history) > 100:
-            # 删除旧记录及其文件
-            for old_record in self.history[100:]:
+        with self.lock:
+            # 检查是否已存在，存在则更新（保持原有位置）
+            existing = self._by_id.get(session_id)
+            if existing is not None:
+                record['created_at'] = existing.get('created_at', record['created_at'])
+                record['updated_at'] = datetime.now().isoformat()
+                self._forget(existing)
+            self._forget(record)
+            self._by_id[session_id] = record
+            self._append({'op': 'add', 'rec': record})
+            
+            # 限制历史记录数量：删除最旧的记录及其文件
+            while len(self._by_id) > self.MAX_RECORDS:
+                old_id, old_record = self._by_id.popitem(last=False)
                 self._cleanup_record(old_record)
-            self.history = self.history[:100]
+                self._forget(old_record)
+                self._append({'op': 'del', 'id': old_id})
         
-        self._save_history()
         return record
     
     def get_history(self, limit: int = 20) -> List[Dict]:
@@ -102,14 +194,15 @@ class HistoryManager:
         Returns:
             历史记录列表
         """
-        # 过滤掉已删除文件的记录
+        # 过滤掉已删除文件的记录，凑够 limit 条即停止检查
         valid_records = []
         for record in self.history:
-            pdf_path = record.get('pdf_path', '')
-            if os.path.exists(pdf_path):
+            if len(valid_records) >= limit:
+                break
+            if self._pdf_exists(record.get('pdf_path', '')):
                 valid_records.append(record)
         
-        return valid_records[:limit]
+        return valid_records
     
     def get_record(self, session_id: str) -> Optional[Dict]:
         """
@@ -121,10 +214,7 @@ class HistoryManager:
         Returns:
             记录或 None
         """
-        for record in self.history:
-            if record['id'] == session_id:
-                return record
-        return None
+        return self._by_id.get(session_id)
     
     def delete_record(self, session_id: str) -> bool:
         """
@@ -136,13 +226,14 @@ class HistoryManager:
         Returns:
             是否成功
         """
-        for i, record in enumerate(self.history):
-            if record['id'] == session_id:
-                self._cleanup_record(record)
-                self.history.pop(i)
-                self._save_history()
-                return True
-        return False
+        with self.lock:
+            record = self._by_id.pop(session_id, None)
+            if record is None:
+                return False
+            self._cleanup_record(record)
+            self._forget(record)
+            self._append({'op': 'del', 'id': session_id})
+            return True
     
     def _cleanup_record(self, record: Dict):
         """清理记录的相关文件"""
@@ -169,7 +260,7 @@ class HistoryManager:
         for record in self.history:
             if (query in record.get('experiment_name', '').lower() or
                 query in record.get('student_name', '').lower()):
-                if os.path.exists(record.get('pdf_path', '')):
+                if self._pdf_exists(record.get('pdf_path', '')):
                     results.append(record)
         
         return results
@@ -181,15 +272,16 @@ class HistoryManager:
         Returns:
             统计数据
         """
-        valid_count = sum(1 for r in self.history if os.path.exists(r.get('pdf_path', '')))
-        
-        experiments = {}
-        for record in self.history:
-            name = record.get('experiment_name', '未知')
-            experiments[name] = experiments.get(name, 0) + 1
+        records = self.history
+        valid_count = 0
+        experiments = Counter()
+        for record in records:
+            if self._pdf_exists(record.get('pdf_path', '')):
+                valid_count += 1
+            experiments[record.get('experiment_name', '未知')] += 1
         
         return {
-            'total_records': len(self.history),
+            'total_records': len(records),
             'valid_records': valid_count,
-            'experiments': experiments
+            'experiments': dict(experiments)
         }
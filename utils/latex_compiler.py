@@ -4,10 +4,31 @@ LaTeX 编译器模块
 """
 
 import os
+import re
+import mmap
+import hashlib
+import functools
 import subprocess
 import shutil
 import tempfile
-from typing import Tuple, Optional
+from typing import Dict, Tuple, Optional
+
+
+# 日志中提示需要再次编译的信息
+_RERUN_RE = re.compile(rb'Rerun to get|Label\(s\) may have changed|Please rerun|Rerun LaTeX')
+
+# 日志中的错误行：以 ! 开头或包含 Error
+_ERROR_LINE_RE = re.compile(rb'^(?:!|.*?Error)', re.MULTILINE)
+
+# 提取错误时只读取日志末尾的这部分（字节），再大的日志也只扫描这一段，报告其中最后的错误
+_LOG_TAIL_BYTES = 64 * 1024
+
+
+@functools.lru_cache(maxsize=8)
+def _ttf_files(fonts_dir: str, mtime_ns: int) -> Tuple[str, ...]:
+    """字体目录中的 .ttf 文件名（按目录修改时间缓存，增删字体后自动刷新）"""
+    with os.scandir(fonts_dir) as entries:
+        return tuple(entry.name for entry in entries if entry.name.endswith('.ttf'))
 
 
 class LaTeXCompiler:
@@ -23,6 +44,8 @@ class LaTeXCompiler:
         """
         self.xelatex_path = xelatex_path
         self.timeout = timeout
+        # 已放好字体的 (字体目录, tex 目录) -> 其中一个字体文件的路径（用于确认目录未被删除）
+        self._fonts_staged: Dict[Tuple[str, str], Optional[str]] = {}
     
     def compile(self, tex_file: str, output_dir: str, fonts_dir: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
         """
@@ -47,26 +70,33 @@ class LaTeXCompiler:
         # 创建输出目录
         os.makedirs(output_dir, exist_ok=True)
         
-        # 如果有字体目录，复制字体到 tex 文件目录
+        env = None
+        
+        # 如果有字体目录，将字体放入 tex 文件目录（模板使用 Path=./ 引用字体）
         if fonts_dir and os.path.exists(fonts_dir):
-            for font_file in os.listdir(fonts_dir):
-                if font_file.endswith('.ttf'):
-                    src = os.path.join(fonts_dir, font_file)
-                    dst = os.path.join(tex_dir, font_file)
-                    if not os.path.exists(dst):
-                        shutil.copy2(src, dst)
+            self._stage_fonts(fonts_dir, tex_dir)
+            
+            # 同时将字体目录加入 XeLaTeX 的字体与输入搜索路径（按字体名查找时使用）
+            env = os.environ.copy()
+            env['OSFONTDIR'] = fonts_dir
+            env['TEXINPUTS'] = fonts_dir + os.pathsep
         
-        # 编译命令
+        # 编译命令（模板不需要执行外部命令，显式关闭 shell escape）
         cmd = [
             self.xelatex_path,
             '-interaction=nonstopmode',
+            '-no-shell-escape',
             '-output-directory=' + tex_dir,
             tex_basename
         ]
         
+        aux_path = os.path.join(tex_dir, f"{tex_name}.aux")
+        log_path = os.path.join(tex_dir, f"{tex_name}.log")
+        
         try:
-            # 运行两次以解决引用问题
+            # 最多运行两次以解决引用问题：.aux 未变化且日志没有要求重新编译时只运行一次
             for i in range(2):
+                aux_before = self._file_digest(aux_path)
                 result = subprocess.run(
                     cmd,
                     cwd=tex_dir,
@@ -74,8 +104,11 @@ class LaTeXCompiler:
                     text=True,
                     timeout=self.timeout,
                     encoding='utf-8',
-                    errors='replace'
+                    errors='replace',
+                    env=env
                 )
+                if self._file_digest(aux_path) == aux_before and not self._needs_rerun(log_path):
+                    break
             
             # 检查 PDF 是否生成
             pdf_path = os.path.join(tex_dir, f"{tex_name}.pdf")
@@ -97,8 +130,7 @@ class LaTeXCompiler:
                 return True, "编译成功", final_pdf
             else:
                 # 提取错误信息
-                log_file = os.path.join(tex_dir, f"{tex_name}.log")
-                error_msg = self._extract_errors(log_file)
+                error_msg = self._extract_errors(log_path)
                 return False, f"编译失败: {error_msg}", None
                 
         except subprocess.TimeoutExpired:
@@ -111,6 +143,59 @@ class LaTeXCompiler:
                 return False, "编译错误: 文件正被占用，请关闭 PDF 阅读器后重试", None
             return False, f"编译错误: {msg}", None
     
+    def _stage_fonts(self, fonts_dir: str, tex_dir: str):
+        """将字体放入 tex 目录，同一目录只处理一次（修改报告后重新编译时直接跳过）"""
+        key = (fonts_dir, os.path.abspath(tex_dir))
+        if key in self._fonts_staged:
+            marker = self._fonts_staged[key]
+            if marker is None or os.path.exists(marker):
+                return
+        
+        marker = None
+        for font_file in _ttf_files(fonts_dir, os.stat(fonts_dir).st_mtime_ns):
+            src = os.path.join(fonts_dir, font_file)
+            dst = os.path.join(tex_dir, font_file)
+            if not os.path.exists(dst):
+                self._link_or_copy(src, dst)
+            marker = dst
+        
+        self._fonts_staged[key] = marker
+    
+    @staticmethod
+    def _file_digest(path: str) -> Optional[bytes]:
+        """文件内容的 BLAKE2 摘要，文件不存在时返回 None"""
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.blake2b(f.read()).digest()
+        except FileNotFoundError:
+            return None
+    
+    @staticmethod
+    def _needs_rerun(log_file: str) -> bool:
+        """日志中是否有需要再次编译的提示（如交叉引用发生变化）"""
+        try:
+            with open(log_file, 'rb') as f:
+                return _RERUN_RE.search(f.read()) is not None
+        except FileNotFoundError:
+            return False
+    
+    @staticmethod
+    def _link_or_copy(src: str, dst: str):
+        """
+        优先创建硬链接（无需拷贝数据），其次符号链接（如跨磁盘），
+        都不可用时（如 Windows 无创建符号链接权限）回退为复制
+        """
+        for link in (os.link, os.symlink):
+            try:
+                link(src, dst)
+                return
+            except FileExistsError:
+                # 并发编译时其他线程已放好
+                return
+            except OSError:
+                continue
+        shutil.copyfile(src, dst)
+    
     def _extract_errors(self, log_file: str) -> str:
         """从日志文件中提取错误信息"""
         if not os.path.exists(log_file):
@@ -118,16 +203,35 @@ class LaTeXCompiler:
         
         errors = []
         try:
-            with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
-                lines = f.readlines()
-                for i, line in enumerate(lines):
-                    if line.startswith('!') or 'Error' in line:
-                        # 获取错误及其上下文
-                        start = max(0, i - 1)
-                        end = min(len(lines), i + 3)
-                        errors.extend(lines[start:end])
-                        if len(errors) > 20:  # 限制错误信息长度
-                            break
+            with open(log_file, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    return "未知错误，请检查 LaTeX 代码"
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    start = max(0, size - _LOG_TAIL_BYTES)
+                    if start:
+                        # 从窗口内第一个完整的行开始
+                        start = mm.find(b'\n', start) + 1 or size
+                    data = mm[start:]
+            
+            lines = data.split(b'\n')
+            # 记录每个错误行的行号（匹配位置之前的换行数），错误通常出现在日志末尾
+            error_lines = []
+            line_no = 0
+            pos = 0
+            for match in _ERROR_LINE_RE.finditer(data):
+                line_no += data.count(b'\n', pos, match.start())
+                pos = match.start()
+                error_lines.append(line_no)
+            
+            # 从最后一个错误往前取“错误行前 1 行、后 2 行”的上下文（重叠部分合并），最多 20 行
+            selected = set()
+            for line_no in reversed(error_lines):
+                context = range(max(0, line_no - 1), min(len(lines), line_no + 3))
+                selected.update(context)
+                if len(selected) >= 20:  # 限制错误信息长度
+                    break
+            errors = [lines[i].rstrip(b'\r').decode('utf-8', errors='replace') for i in sorted(selected)[-20:]]
         except:
             return "无法解析日志文件"
         
@@ -3,19 +3,129 @@ PDF 文本提取模块
 从实验指导书 PDF 中提取文字内容
 """
 
+import io
 import os
-from typing import Optional
+import re
+import json
+import mmap
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import Iterator, Optional, Tuple
+
+# PyMuPDF 基于 MuPDF 的 C 实现，提取速度远快于 PyPDF2（旧版本只提供 fitz 模块名）
+try:
+    import pymupdf
+    PYMUPDF_AVAILABLE = True
+except ImportError:
+    try:
+        import fitz as pymupdf
+        PYMUPDF_AVAILABLE = True
+    except ImportError:
+        PYMUPDF_AVAILABLE = False
+
+# pypdfium2 调用 PDFium（C++）引擎，同样远快于纯 Python 的 PyPDF2
+try:
+    import pypdfium2 as pdfium
+    PYPDFIUM2_AVAILABLE = True
+except ImportError:
+    PYPDFIUM2_AVAILABLE = False
 
 try:
     from PyPDF2 import PdfReader
-    PDF_AVAILABLE = True
+    PYPDF2_AVAILABLE = True
+except ImportError:
+    PYPDF2_AVAILABLE = False
+
+PDF_AVAILABLE = PYMUPDF_AVAILABLE or PYPDFIUM2_AVAILABLE or PYPDF2_AVAILABLE
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
 except ImportError:
-    PDF_AVAILABLE = False
+    TIKTOKEN_AVAILABLE = False
+
+
+# extract_text_from_pdf 插入的分页标记
+_PAGE_MARKER_RE = re.compile(r'^=== 第 (\d+) 页 ===$')
+# 单独成行的页码，如 "12"、"- 12 -"、"第 12 页"、"12/30"
+_PAGE_NUMBER_RE = re.compile(r'^(?:[-—\s]*\d+[-—\s]*|第\s*\d+\s*页(?:\s*共\s*\d+\s*页)?|\d+\s*/\s*\d+)$')
+_WHITESPACE_RE = re.compile(r'[ \t\u3000]+')
+
+# 指导书各部分的常见标题（按优先级排列：一行同时包含多个标题时取靠前的部分）
+_GUIDE_SECTIONS = {
+    'experiment_purpose': ['实验目的', '一、实验目的', '1.实验目的', '1、实验目的'],
+    'equipment': ['实验仪器', '实验器材', '仪器设备', '二、实验仪器', '2.实验仪器'],
+    'principle': ['实验原理', '三、实验原理', '3.实验原理', '原理简介'],
+    'steps': ['实验步骤', '实验内容', '操作步骤', '四、实验步骤', '4.实验步骤'],
+    'notes': ['注意事项', '思考题', '要求', '预习要求']
+}
+# 每个部分一个分支，分支内用前瞻在整行中查找标题，按分支顺序尝试即保留了优先级；
+# 匹配的分组名（lastgroup）即所属部分
+_SECTION_RE = re.compile('|'.join(
+    f"(?=.*?(?P<{key}>{'|'.join(map(re.escape, titles))}))"
+    for key, titles in _GUIDE_SECTIONS.items()
+), re.DOTALL)
+# 任意一个标题，先用它一次扫描排除没有标题的行（绝大多数行），再由 _SECTION_RE 判断所属部分
+_ANY_TITLE_RE = re.compile('|'.join(
+    re.escape(title) for titles in _GUIDE_SECTIONS.values() for title in titles
+))
+
+
+def _match_section(line: str) -> Optional[str]:
+    """返回行中标题所属的部分（包含多个部分的标题时取优先级最高的），没有标题时返回 None"""
+    if not _ANY_TITLE_RE.search(line):
+        return None
+    match = _SECTION_RE.match(line)
+    return match.lastgroup if match else None
+
+
+def _iter_pages_pymupdf(pdf_path: str, max_pages: int) -> Iterator[str]:
+    """使用 PyMuPDF 逐页提取文本"""
+    with pymupdf.open(pdf_path) as doc:
+        for i in range(min(doc.page_count, max_pages)):
+            yield doc[i].get_text("text")
+
+
+def _iter_pages_pypdfium2(pdf_path: str, max_pages: int) -> Iterator[str]:
+    """使用 pypdfium2 逐页提取文本（每页一次 get_text_range 调用）"""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for i in range(min(len(pdf), max_pages)):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            try:
+                # PDFium 以 \r\n 分行，统一为 \n 与其他提取方式保持一致
+                text = textpage.get_text_range().replace('\r\n', '\n')
+            finally:
+                textpage.close()
+                page.close()
+            yield text
+    finally:
+        pdf.close()
+
+
+def _iter_pages_pypdf2(pdf_path: str, max_pages: int) -> Iterator[str]:
+    """使用 PyPDF2 逐页提取文本"""
+    reader = PdfReader(pdf_path)
+    for i in range(min(len(reader.pages), max_pages)):
+        yield reader.pages[i].extract_text()
+
+
+def _page_iterators(pdf_path: str, max_pages: int):
+    """按优先级依次给出各个可用提取方式的 (名称, 逐页文本迭代器)"""
+    if PYMUPDF_AVAILABLE:
+        yield 'PyMuPDF', _iter_pages_pymupdf(pdf_path, max_pages)
+    if PYPDFIUM2_AVAILABLE:
+        yield 'pypdfium2', _iter_pages_pypdfium2(pdf_path, max_pages)
+    if PYPDF2_AVAILABLE:
+        yield 'PyPDF2', _iter_pages_pypdf2(pdf_path, max_pages)
 
 
 def extract_text_from_pdf(pdf_path: str, max_pages: int = 20) -> Optional[str]:
     """
-    从 PDF 文件中提取文本
+    从 PDF 文件中提取文本（依次尝试 PyMuPDF、pypdfium2、PyPDF2，未安装或解析失败时使用下一个）
     
     Args:
         pdf_path: PDF 文件路径
@@ -25,46 +135,145 @@ def extract_text_from_pdf(pdf_path: str, max_pages: int = 20) -> Optional[str]:
         提取的文本内容，失败返回 None
     """
     if not PDF_AVAILABLE:
-        print("PyPDF2 未安装，无法提取 PDF 文本")
+        print("PyMuPDF、pypdfium2 与 PyPDF2 均未安装，无法提取 PDF 文本")
         return None
     
     if not os.path.exists(pdf_path):
         print(f"PDF 文件不存在: {pdf_path}")
         return None
     
-    try:
-        reader = PdfReader(pdf_path)
-        text_parts = []
-        
-        # 限制页数
-        pages_to_read = min(len(reader.pages), max_pages)
-        
-        for i in range(pages_to_read):
-            page = reader.pages[i]
-            text = page.extract_text()
-            if text:
-                text_parts.append(f"=== 第 {i+1} 页 ===\n{text}")
+    for name, pages in _page_iterators(pdf_path, max_pages):
+        # 逐页写入缓冲区，不保留各页文本的列表；中途失败则丢弃已写入的内容改用下一个提取方式
+        buf = io.StringIO()
+        try:
+            for i, text in enumerate(pages):
+                if text:
+                    if buf.tell():
+                        buf.write("\n\n")
+                    buf.write(f"=== 第 {i+1} 页 ===\n")
+                    buf.write(text)
+        except Exception as e:
+            print(f"PDF 提取失败 ({name}): {e}")
+            continue
         
-        if text_parts:
-            return "\n\n".join(text_parts)
-        else:
-            return None
-            
-    except Exception as e:
-        print(f"PDF 提取失败: {e}")
-        return None
+        return buf.getvalue() or None
+    
+    return None
+
+
+def _file_sha1(path: str) -> str:
+    """计算文件内容的 SHA-1（通过 mmap 读取，避免整份复制到内存）"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha1(b'').hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha1(mm).hexdigest()
+
+
+# 指导书提取结果缓存：内存中最多保留的份数、磁盘缓存目录中最多保留的 JSON 文件数
+GUIDE_MEMORY_CACHE_SIZE = 64
+GUIDE_DISK_CACHE_SIZE = 256
+
+# (内容哈希, 缓存目录) -> 提取结果，只保存非空结果，按最近使用顺序淘汰
+_guide_cache: 'OrderedDict[Tuple[str, Optional[str]], dict]' = OrderedDict()
+_guide_cache_lock = threading.Lock()
+
+
+def _prune_disk_cache(cache_dir: str):
+    """磁盘缓存超过 GUIDE_DISK_CACHE_SIZE 份时，删除最久未使用的文件"""
+    try:
+        with os.scandir(cache_dir) as entries:
+            files = [(entry.stat().st_mtime_ns, entry.path) for entry in entries if entry.name.endswith('.json')]
+    except OSError:
+        return
+    if len(files) <= GUIDE_DISK_CACHE_SIZE:
+        return
+    files.sort()
+    for _, path in files[:len(files) - GUIDE_DISK_CACHE_SIZE]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _load_guide_content(digest: str, pdf_path: str, cache_dir: Optional[str]) -> dict:
+    """先查磁盘缓存，未命中再解析 PDF 并写入缓存"""
+    cache_path = os.path.join(cache_dir, digest + '.json') if cache_dir else None
+    
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            # 刷新修改时间，清理磁盘缓存时按最近使用保留
+            os.utime(cache_path)
+            return result
+        except (OSError, ValueError) as e:
+            print(f"读取 PDF 缓存失败，将重新提取: {e}")
+    
+    result = _parse_guide_content(pdf_path)
+    
+    # 只缓存成功的结果，避免缺少依赖等临时问题被长期记住
+    if cache_path and result:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"写入 PDF 缓存失败: {e}")
+        _prune_disk_cache(cache_dir)
+    
+    return result
+
+
+def _cached_guide_content(digest: str, pdf_path: str, cache_dir: Optional[str]) -> dict:
+    """按 (内容哈希, 缓存目录) 缓存的提取结果；每次上传的路径都不同，路径不参与缓存键"""
+    key = (digest, cache_dir)
+    with _guide_cache_lock:
+        result = _guide_cache.get(key)
+        if result is not None:
+            _guide_cache.move_to_end(key)
+            return result
+    
+    result = _load_guide_content(digest, pdf_path, cache_dir)
+    
+    if result:
+        with _guide_cache_lock:
+            _guide_cache[key] = result
+            _guide_cache.move_to_end(key)
+            while len(_guide_cache) > GUIDE_MEMORY_CACHE_SIZE:
+                _guide_cache.popitem(last=False)
+    
+    return result
 
 
-def extract_guide_content(pdf_path: str) -> dict:
+def extract_guide_content(pdf_path: str, cache_dir: Optional[str] = None) -> dict:
     """
     从实验指导书中提取结构化内容
     
+    相同内容的 PDF 只解析一次：非空结果按文件 SHA-1 缓存在内存中（与文件路径无关），
+    指定 cache_dir 时还会保存为 JSON（最多 GUIDE_DISK_CACHE_SIZE 份），服务重启后仍可复用
+    
     Args:
         pdf_path: 实验指导书 PDF 路径
+        cache_dir: 磁盘缓存目录，None 则只使用内存缓存
         
     Returns:
         包含各部分内容的字典
     """
+    try:
+        digest = _file_sha1(pdf_path)
+    except (OSError, ValueError) as e:
+        print(f"无法读取 PDF 文件: {e}")
+        return {}
+    
+    # 返回副本，调用方修改结果不会影响缓存
+    return dict(_cached_guide_content(digest, pdf_path, cache_dir))
+
+
+def _parse_guide_content(pdf_path: str) -> dict:
+    """解析 PDF 并按常见标题拆分各部分内容"""
     text = extract_text_from_pdf(pdf_path)
     
     if not text:
@@ -79,16 +288,7 @@ def extract_guide_content(pdf_path: str) -> dict:
         'notes': ''
     }
     
-    # 尝试识别各部分（基于常见标题）
-    sections = {
-        'experiment_purpose': ['实验目的', '一、实验目的', '1.实验目的', '1、实验目的'],
-        'equipment': ['实验仪器', '实验器材', '仪器设备', '二、实验仪器', '2.实验仪器'],
-        'principle': ['实验原理', '三、实验原理', '3.实验原理', '原理简介'],
-        'steps': ['实验步骤', '实验内容', '操作步骤', '四、实验步骤', '4.实验步骤'],
-        'notes': ['注意事项', '思考题', '要求', '预习要求']
-    }
-    
-    # 简单的段落分割
+    # 简单的段落分割，按常见标题（_GUIDE_SECTIONS）识别各部分
     lines = text.split('\n')
     current_section = None
     current_content = []
@@ -96,15 +296,10 @@ def extract_guide_content(pdf_path: str) -> dict:
     for line in lines:
         line_stripped = line.strip()
         
-        # 检查是否是新的章节标题
+        # 检查是否是新的章节标题（标题行较短，长行不视为标题）
         found_section = None
-        for section_key, titles in sections.items():
-            for title in titles:
-                if title in line_stripped and len(line_stripped) < 50:
-                    found_section = section_key
-                    break
-            if found_section:
-                break
+        if len(line_stripped) < 50:
+            found_section = _match_section(line_stripped)
         
         if found_section:
             # 保存前一个章节的内容
@@ -120,3 +315,100 @@ def extract_guide_content(pdf_path: str) -> dict:
         result[current_section] = '\n'.join(current_content).strip()
     
     return result
+
+
+# 等待 tiktoken 加载编码的最长时间（秒）
+_ENCODING_LOAD_TIMEOUT = 5
+
+
+def _load_encoding(model: Optional[str]):
+    """加载模型对应的 tiktoken 编码，未知模型使用 cl100k_base，失败时返回 None"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        pass
+    try:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model: Optional[str]):
+    """
+    获取模型对应的 tiktoken 编码，不可用时返回 None
+    
+    编码文件不在本地缓存时 tiktoken 会联网下载且没有超时，离线时会一直卡住，
+    因此在后台线程中加载并限时等待；结果（包括超时得到的 None）由 lru_cache 缓存，不会重复尝试
+    """
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    result = []
+    loader = threading.Thread(target=lambda: result.append(_load_encoding(model)), daemon=True)
+    loader.start()
+    loader.join(_ENCODING_LOAD_TIMEOUT)
+    return result[0] if result else None
+
+
+def condense_guide_text(text: str, max_tokens: int = 16000, max_chars: int = 32768,
+                        model: Optional[str] = None) -> str:
+    """
+    精简指导书文本，减少发送给 AI 的 token 数
+    
+    去掉分页标记、单独成行的页码，以及在多数页面重复出现的页眉页脚，
+    合并多余空白后按 token 数截断（tiktoken 不可用时仅按字符数截断）。
+    
+    Args:
+        text: extract_text_from_pdf 提取的文本
+        max_tokens: 最大 token 数
+        max_chars: 最大字符数
+        model: 模型名称（用于选择 token 编码）
+        
+    Returns:
+        精简后的文本
+    """
+    if not text:
+        return text
+    
+    # 按分页标记切分，统计每行出现在多少个页面中
+    pages = []
+    current = []
+    for line in text.split('\n'):
+        line = _WHITESPACE_RE.sub(' ', line).strip()
+        if _PAGE_MARKER_RE.match(line):
+            if current:
+                pages.append(current)
+            current = []
+        else:
+            current.append(line)
+    if current:
+        pages.append(current)
+    
+    page_counts = Counter()
+    for page_lines in pages:
+        page_counts.update(set(line for line in page_lines if line))
+    
+    # 在至少 3 页且过半页面中重复出现的行视为页眉页脚
+    repeat_threshold = max(3, len(pages) // 2 + 1)
+    
+    kept = []
+    for page_lines in pages:
+        for line in page_lines:
+            if not line:
+                # 合并连续空行
+                if kept and kept[-1]:
+                    kept.append('')
+                continue
+            if _PAGE_NUMBER_RE.match(line) or page_counts[line] >= repeat_threshold:
+                continue
+            kept.append(line)
+    
+    condensed = '\n'.join(kept).strip()
+    
+    encoding = _get_encoding(model) if max_tokens else None
+    if encoding is not None:
+        tokens = encoding.encode(condensed, disallowed_special=())
+        if len(tokens) > max_tokens:
+            condensed = encoding.decode(tokens[:max_tokens])
+    
+    return condensed[:max_chars]
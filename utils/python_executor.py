@@ -5,25 +5,405 @@ Python 代码执行模块
 
 import os
 import sys
+import json
+import queue
+import atexit
+import threading
+import collections
 import subprocess
 import tempfile
 import re
-from typing import Tuple, List, Optional
+from pathlib import PurePath
+from typing import Tuple, List, Optional, Dict, Any
+
+
+# 画图脚本的执行超时（秒）
+PLOT_TIMEOUT = 60
+
+# 脚本不再写入磁盘，此名称仅用于错误信息中的文件名
+PLOT_SCRIPT_NAME = 'plot_script.py'
+
+# 常驻画图进程累计执行该数量的任务后重启
+PLOT_WORKER_MAX_JOBS = 20
+
+# 脚本输出只保留末尾部分（错误信息在最后），避免大量打印占满内存：
+# 按块读取，最多保留 OUTPUT_TAIL_CHUNKS 块
+OUTPUT_CHUNK_SIZE = 4096
+OUTPUT_TAIL_CHUNKS = 128
+
+# 视为画图结果的图片扩展名
+_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.pdf', '.svg')
+
+# 预处理画图代码与提取 AI 响应中代码块所用的正则
+_SHOW_RE = re.compile(r'plt\.show\(\)')
+# plt.savefig('...') 与 fig.savefig("...") 等以字符串字面量指定路径的调用，path 分组为原路径
+_SAVEFIG_RE = re.compile(r"""(?P<pre>(?:plt\.)?savefig\(\s*['"])(?P<path>[^'"]+)(?P<post>['"][^)]*\))""")
+_CODE_BLOCK_RE = re.compile(r'```(?:python)?\n(.*?)```', re.DOTALL | re.IGNORECASE)
+_PY_PREFIX_RE = re.compile(r'^python\s*\n', re.IGNORECASE)
+# 代码块分类所需的特征，一次扫描统计各分组出现次数（各特征互不重叠，计数与 str.count 一致）
+_CLASSIFY_RE = re.compile(r'(?P<plt>plt\.)|(?P<mpl>matplotlib)|(?P<np>np\.array)|(?P<data>data(?: =|_))')
+
+# 画图使用的 matplotlib 设置（中文字体等）
+PLOT_RC_PARAMS = {
+    'font.sans-serif': ['SimHei', 'SimSun', 'Songti', 'Microsoft YaHei', 'DejaVu Sans'],
+    'axes.unicode_minus': False,
+    'font.size': 12,
+}
+
+# 画图脚本的开头部分：导入常用库、注册字体、应用 PLOT_RC_PARAMS 并确定输出目录
+_SCRIPT_HEADER = '''# Auto-generated plotting script
+import os
+import sys
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # 非交互式后端
+import matplotlib.pyplot as plt
+from matplotlib import font_manager
+from scipy.optimize import curve_fit
+
+# 注册工作目录和字体目录下的字体文件（常驻画图进程中已注册过的字体不再重复解析）
+font_paths = {font_paths!r}
+registered_fonts = {{f.fname for f in font_manager.fontManager.ttflist}}
+for font_path in font_paths:
+    if font_path not in registered_fonts:
+        try:
+            font_manager.fontManager.addfont(font_path)
+        except:
+            pass
+
+# 设置中文字体
+plt.rcParams.update({rc_params!r})
+
+# 输出目录
+save_dir = r"{fig_dir}"
+os.makedirs(save_dir, exist_ok=True)
+
+'''
+
+# 常驻画图进程的源码：启动时预先导入 numpy / matplotlib / scipy，
+# 之后从 stdin 逐行读取任务（JSON，包含脚本源码），在全新的命名空间中执行脚本，
+# 执行结果以一行 JSON 写回。脚本自身的输出被单独捕获，不会混入通信管道。
+# 每个任务结束后恢复启动时的 sys.modules、sys.path、环境变量、警告过滤器与 numpy 设置，
+# 无法还原的改动（如给已导入模块打补丁）由 _PlotWorker 定期重启进程来清除
+_WORKER_SRC = r'''
+import io, os, sys, json, linecache, traceback, warnings, collections
+
+class _TailWriter(io.TextIOBase):
+    """只保留最后 limit 个字符左右的输出"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.parts = collections.deque()
+        self.size = 0
+    def writable(self):
+        return True
+    def write(self, s):
+        self.parts.append(s)
+        self.size += len(s)
+        while len(self.parts) > 1 and self.size - len(self.parts[0]) >= self.limit:
+            self.size -= len(self.parts.popleft())
+        return len(s)
+    def getvalue(self):
+        return ''.join(self.parts)
+
+proto_out = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+os.dup2(2, 1)
+proto_in = sys.stdin
+sys.stdin = open(os.devnull)
+
+for _name in ('numpy', 'scipy.optimize'):
+    try:
+        __import__(_name)
+    except Exception:
+        pass
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib import font_manager
+    # 先画一张图，让保存图片时才导入的后端等模块进入基准快照，之后不必每次重新导入
+    plt.plot([0, 1])
+    plt.savefig(io.BytesIO(), format='png')
+    plt.close('all')
+except Exception:
+    matplotlib = plt = None
+try:
+    import numpy
+except Exception:
+    numpy = None
+
+# 任务间需要还原的进程状态
+base_modules = set(sys.modules)
+base_path = list(sys.path)
+base_environ = dict(os.environ)
+base_filters = list(warnings.filters)
+base_np = (numpy.get_printoptions(), numpy.geterr()) if numpy is not None else None
+
+def reset_state():
+    for name in [m for m in sys.modules if m not in base_modules]:
+        del sys.modules[name]
+    sys.path[:] = base_path
+    if os.environ != base_environ:
+        os.environ.clear()
+        os.environ.update(base_environ)
+    warnings.resetwarnings()
+    warnings.filters[:] = base_filters
+    if base_np is not None:
+        numpy.set_printoptions(**base_np[0])
+        numpy.seterr(**base_np[1])
+
+for line in proto_in:
+    job = json.loads(line)
+    out, err = _TailWriter(job['tail']), _TailWriter(job['tail'])
+    returncode = 0
+    sys.stdout, sys.stderr = out, err
+    sys.path.insert(0, job['cwd'])
+    try:
+        os.chdir(job['cwd'])
+        if plt is not None:
+            # 清理上一个任务留下的图形和样式设置
+            plt.close('all')
+            matplotlib.rcdefaults()
+        # 脚本没有写入磁盘，登记到 linecache 让错误堆栈仍能显示出错的代码行
+        linecache.cache[job['filename']] = (len(job['source']), None, job['source'].splitlines(True), job['filename'])
+        exec(compile(job['source'], job['filename'], 'exec'), {'__name__': '__main__', '__file__': job['filename']})
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            returncode = e.code or 0
+        else:
+            print(e.code, file=err)
+            returncode = 1
+    except BaseException:
+        traceback.print_exc(file=err)
+        returncode = 1
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        try:
+            reset_state()
+        except Exception:
+            # 状态无法还原时通知主进程重启画图进程
+            returncode = returncode or 1
+    proto_out.write(json.dumps({'returncode': returncode, 'stdout': out.getvalue(), 'stderr': err.getvalue()}) + '\n')
+    proto_out.flush()
+'''
+
+
+class _PlotWorker:
+    """
+    常驻的画图子进程，避免每次画图都重新导入 matplotlib 等库
+    
+    同一时间只执行一个任务；忙碌或无法启动时 run() 返回 None，由调用方改用一次性子进程执行。
+    脚本执行失败或累计执行 PLOT_WORKER_MAX_JOBS 个任务后重启进程，
+    使上一个任务留下的、无法在进程内还原的改动不会影响后续任务
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.lines = None
+        self.jobs = 0
+        self.lock = threading.Lock()
+    
+    def _start(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, '-u', '-c', _WORKER_SRC],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding='utf-8',
+            errors='replace'
+        )
+        self.lines = queue.Queue()
+        self.jobs = 0
+        threading.Thread(target=self._read_lines, args=(self.proc.stdout, self.lines), daemon=True).start()
+    
+    @staticmethod
+    def _read_lines(stream, lines):
+        for line in stream:
+            lines.put(line)
+        lines.put(None)  # 进程已退出
+    
+    def prestart(self):
+        """提前启动画图进程（已在运行或正忙时不做任何事），首次画图时无需等待导入各个库"""
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.proc is None or self.proc.poll() is not None:
+                self._start()
+        except OSError:
+            self.proc = None
+        finally:
+            self.lock.release()
+    
+    def stop(self):
+        """结束画图进程（下次使用时重新启动）"""
+        if self.proc is not None:
+            try:
+                self.proc.kill()
+                self.proc.wait(timeout=5)
+            except Exception:
+                pass
+            self.proc = None
+    
+    def _restart(self):
+        """结束当前进程并立即启动新进程（库的导入在后台进行）"""
+        self.stop()
+        try:
+            self._start()
+        except OSError:
+            self.proc = None
+    
+    def run(self, source: str, cwd: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        在常驻进程中执行脚本源码
+        
+        Returns:
+            {'returncode', 'stdout', 'stderr'}，无法使用常驻进程时返回 None；
+            脚本已提交后进程意外退出时返回失败结果，不再由调用方重新执行脚本
+            
+        Raises:
+            subprocess.TimeoutExpired: 执行超时（进程会被结束）
+        """
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if self.proc is None or self.proc.poll() is not None:
+                try:
+                    self._start()
+                except OSError:
+                    self.proc = None
+                    return None
+            
+            try:
+                self.proc.stdin.write(json.dumps({
+                    'source': source,
+                    'filename': os.path.join(cwd, PLOT_SCRIPT_NAME),
+                    'cwd': cwd,
+                    'tail': OUTPUT_CHUNK_SIZE * OUTPUT_TAIL_CHUNKS
+                }) + '\n')
+                self.proc.stdin.flush()
+            except OSError:
+                self.stop()
+                return None
+            
+            try:
+                line = self.lines.get(timeout=timeout)
+            except queue.Empty:
+                self.stop()
+                raise subprocess.TimeoutExpired(PLOT_SCRIPT_NAME, timeout)
+            
+            if line is None:
+                # 脚本可能已经执行了一部分（如导致解释器崩溃），不再重复执行
+                self._restart()
+                return {'returncode': 1, 'stdout': '', 'stderr': '画图进程意外退出'}
+            
+            result = json.loads(line)
+            self.jobs += 1
+            if result['returncode'] != 0 or self.jobs >= PLOT_WORKER_MAX_JOBS:
+                self._restart()
+            return result
+        finally:
+            self.lock.release()
+
+
+_plot_worker = _PlotWorker()
+atexit.register(_plot_worker.stop)
+
+
+def _read_tail(stream, chunks: collections.deque):
+    """持续读取管道直到关闭，deque 只保留最后若干块"""
+    for chunk in iter(lambda: stream.read(OUTPUT_CHUNK_SIZE), b''):
+        chunks.append(chunk)
+    stream.close()
+
+
+def _run_script(source: str, cwd: str, timeout: float) -> Dict[str, Any]:
+    """
+    在一次性子进程中执行脚本（源码经 stdin 传入，不写入磁盘），输出边产生边读取，只保留末尾部分
+    
+    Returns:
+        {'returncode', 'stdout', 'stderr'}
+        
+    Raises:
+        subprocess.TimeoutExpired: 执行超时（进程会被结束）
+    """
+    proc = subprocess.Popen(
+        [sys.executable, '-'],
+        cwd=cwd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=0
+    )
+    tails = {}
+    readers = []
+    for name, stream in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+        tails[name] = collections.deque(maxlen=OUTPUT_TAIL_CHUNKS)
+        reader = threading.Thread(target=_read_tail, args=(stream, tails[name]), daemon=True)
+        reader.start()
+        readers.append(reader)
+    
+    try:
+        # 子进程读完 stdin 后才开始执行，输出由读取线程并行接收，写入不会阻塞
+        try:
+            proc.stdin.write(source.encode('utf-8'))
+            proc.stdin.close()
+        except OSError:
+            pass
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join(timeout=5)
+    
+    result = {'returncode': returncode}
+    for name, chunks in tails.items():
+        result[name] = b''.join(chunks).decode('utf-8', 'replace')
+    return result
+
+
+def prestart_plot_worker():
+    """提前启动常驻画图进程，让库的导入与其他准备工作（如调用 AI）同时进行"""
+    _plot_worker.prestart()
 
 
 class PythonExecutor:
     """Python 代码执行器"""
     
-    def __init__(self, work_dir: str):
+    def __init__(self, work_dir: str, fonts_dir: Optional[str] = None):
         """
         初始化执行器
         
         Args:
             work_dir: 工作目录（图片将保存在此目录的 Fig 子目录）
+            fonts_dir: 字体目录（可选，其中的 .ttf 字体会注册给 matplotlib）
         """
         self.work_dir = work_dir
+        self.fonts_dir = fonts_dir
         self.fig_dir = os.path.join(work_dir, 'Fig')
         os.makedirs(self.fig_dir, exist_ok=True)
+        # 字体文件在创建时查找一次，直接写入脚本
+        self.font_paths = self._find_font_paths([d for d in (work_dir, fonts_dir) if d])
+        # 脚本开头只与目录有关，创建时生成一次
+        self._header = _SCRIPT_HEADER.format(
+            font_paths=self.font_paths,
+            rc_params=PLOT_RC_PARAMS,
+            fig_dir=self.fig_dir
+        )
+    
+    @staticmethod
+    def _find_font_paths(font_dirs: List[str]) -> List[str]:
+        """查找各目录下的 .ttf 字体文件"""
+        font_paths = []
+        for font_dir in font_dirs:
+            try:
+                with os.scandir(font_dir) as entries:
+                    font_paths.extend(entry.path for entry in entries if entry.name.lower().endswith('.ttf'))
+            except OSError:
+                continue
+        return font_paths
     
     def execute_plotting_code(self, code: str, data_code: str = None) -> Tuple[bool, str, List[str]]:
         """
@@ -39,34 +419,26 @@ class PythonExecutor:
         # 预处理代码
         processed_code = self._preprocess_code(code, data_code)
         
-        # 写入临时文件
-        script_path = os.path.join(self.work_dir, 'plot_script.py')
-        with open(script_path, 'w', encoding='utf-8') as f:
-            f.write(processed_code)
+        # 记录执行前已有的图片，执行后只返回新生成或被覆盖的图片
+        before = self._snapshot_images()
         
         try:
-            # 执行脚本
-            result = subprocess.run(
-                [sys.executable, script_path],
-                cwd=self.work_dir,
-                capture_output=True,
-                text=True,
-                timeout=60,
-                encoding='utf-8',
-                errors='replace'
-            )
+            # 优先交给常驻画图进程执行，不可用时启动一次性子进程
+            result = _plot_worker.run(processed_code, self.work_dir, PLOT_TIMEOUT)
+            if result is None:
+                result = _run_script(processed_code, self.work_dir, PLOT_TIMEOUT)
             
             # 检查生成的图片
-            generated_images = self._find_generated_images()
+            generated_images = self._find_generated_images(before)
             
-            if result.returncode == 0:
+            if result['returncode'] == 0:
                 return True, f"代码执行成功，生成了 {len(generated_images)} 张图片", generated_images
             else:
-                error_msg = result.stderr or result.stdout or "未知错误"
-                return False, f"代码执行失败: {error_msg[:500]}", generated_images
+                error_msg = result['stderr'] or result['stdout'] or "未知错误"
+                return False, f"代码执行失败: {error_msg[-500:]}", generated_images
                 
         except subprocess.TimeoutExpired:
-            return False, "代码执行超时（60秒）", []
+            return False, f"代码执行超时（{PLOT_TIMEOUT}秒）", []
         except Exception as e:
             return False, f"执行错误: {str(e)}", []
     
@@ -74,37 +446,7 @@ class PythonExecutor:
         """预处理代码，设置保存路径等"""
         
         # 添加导入和配置
-        header = f'''# Auto-generated plotting script
-import os
-import sys
-import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # 非交互式后端
-import matplotlib.pyplot as plt
-from matplotlib import font_manager
-from scipy.optimize import curve_fit
-
-# 尝试加载当前目录下的字体文件
-work_dir = r"{self.work_dir}"
-for f in os.listdir(work_dir):
-    if f.lower().endswith('.ttf'):
-        try:
-            font_path = os.path.join(work_dir, f)
-            font_manager.fontManager.addfont(font_path)
-            # print(f"Registered font: {{f}}")
-        except:
-            pass
-
-# 设置中文字体
-plt.rcParams['font.sans-serif'] = ['SimHei', 'SimSun', 'Songti', 'Microsoft YaHei', 'DejaVu Sans']
-plt.rcParams['axes.unicode_minus'] = False
-plt.rcParams['font.size'] = 12
-
-# 输出目录
-save_dir = r"{self.fig_dir}"
-os.makedirs(save_dir, exist_ok=True)
-
-'''
+        header = self._header
         
         # 如果有数据代码，添加到开头
         if data_code:
@@ -114,32 +456,47 @@ os.makedirs(save_dir, exist_ok=True)
         processed = code
         
         # 替换 plt.show() 为空（我们不需要显示）
-        processed = re.sub(r'plt\.show\(\)', '# plt.show()  # Disabled', processed)
+        processed = _SHOW_RE.sub('# plt.show()  # Disabled', processed)
         
         # 确保 savefig 使用正确的路径
-        # 如果代码中有相对路径的 savefig，替换为绝对路径
+        # 如果代码中有相对路径的 savefig，替换为绝对路径（只保留文件名，统一保存到 Fig 目录）
         def replace_savefig(match):
-            original = match.group(0)
-            path_match = re.search(r"savefig\(['\"]([^'\"]+)['\"]", original)
-            if path_match:
-                old_path = path_match.group(1)
-                filename = os.path.basename(old_path)
-                new_path = os.path.join(self.fig_dir, filename).replace('\\', '/')
-                return original.replace(old_path, new_path)
-            return original
-        
-        processed = re.sub(r'plt\.savefig\([^)]+\)', replace_savefig, processed)
-        processed = re.sub(r'savefig\([^)]+\)', replace_savefig, processed)
+            new_path = os.path.join(self.fig_dir, os.path.basename(match['path'])).replace('\\', '/')
+            return match['pre'] + new_path + match['post']
+        
+        processed = _SAVEFIG_RE.sub(replace_savefig, processed)
         
         return header + processed
     
-    def _find_generated_images(self) -> List[str]:
-        """查找生成的图片文件"""
-        images = []
-        if os.path.exists(self.fig_dir):
-            for f in os.listdir(self.fig_dir):
-                if f.lower().endswith(('.png', '.jpg', '.jpeg', '.pdf', '.svg')):
-                    images.append(os.path.join(self.fig_dir, f))
+    def _snapshot_images(self) -> Dict[str, int]:
+        """记录 Fig 目录中现有图片的修改时间：文件名 -> st_mtime_ns"""
+        snapshot = {}
+        try:
+            with os.scandir(self.fig_dir) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(_IMAGE_EXTENSIONS):
+                        try:
+                            snapshot[entry.name] = entry.stat().st_mtime_ns
+                        except OSError:
+                            continue
+        except OSError:
+            pass
+        return snapshot
+    
+    def _find_generated_images(self, before: Optional[Dict[str, int]] = None) -> List[str]:
+        """
+        查找生成的图片文件
+        
+        Args:
+            before: 执行前的目录快照（_snapshot_images 的结果），为空时返回全部图片
+        """
+        before = before or {}
+        after = self._snapshot_images()
+        images = [
+            os.path.join(self.fig_dir, name)
+            for name, mtime_ns in after.items()
+            if before.get(name) != mtime_ns
+        ]
         return sorted(images)
 
 
@@ -157,14 +514,14 @@ def extract_python_code_from_ai_response(response: str) -> Tuple[Optional[str],
         return None, None
 
     # 1. 查找所有 Python 代码块
-    code_blocks = re.findall(r'```(?:python)?\n(.*?)```', response, re.DOTALL | re.IGNORECASE)
+    code_blocks = _CODE_BLOCK_RE.findall(response)
     
     # 2. 如果没找到带反引号的，检查是否全是代码（比如后端已经清理过但没提取好的情况）
     if not code_blocks:
         # 如果包含明显的 python 绘图特征且没有反引号，尝试作为单一块处理
         if 'import matplotlib' in response or 'plt.' in response:
             # 移除可能存在的 "python" 单词头
-            clean_response = re.sub(r'^python\s*\n', '', response.strip(), flags=re.IGNORECASE)
+            clean_response = _PY_PREFIX_RE.sub('', response.strip())
             code_blocks = [clean_response]
             
     if not code_blocks:
@@ -175,13 +532,15 @@ def extract_python_code_from_ai_response(response: str) -> Tuple[Optional[str],
     plot_code_list = []
     
     for code in code_blocks:
+        features = collections.Counter(m.lastgroup for m in _CLASSIFY_RE.finditer(code))
+        
         # 检查是否是数据定义 (包含数组定义)
-        if 'np.array' in code or 'data =' in code or 'data_' in code:
-            if 'plt.' not in code or code.count('np.array') > 1:
+        if features['np'] or features['data']:
+            if not features['plt'] or features['np'] > 1:
                 data_code_list.append(code)
         
         # 检查是否是画图代码
-        if 'plt.' in code or 'matplotlib' in code:
+        if features['plt'] or features['mpl']:
             plot_code_list.append(code)
     
     # 合并代码块
@@ -191,6 +550,15 @@ def extract_python_code_from_ai_response(response: str) -> Tuple[Optional[str],
     return data_code, plot_code
 
 
+# 单张图片的 figure 环境（依次填入相对路径与标题）
+_FIG_TEMPLATE = """\\begin{{figure}}[H]
+    \\centering
+    \\includegraphics[width=0.8\\textwidth]{{{}}}
+    \\caption{{{}}}
+\\end{{figure}}
+"""
+
+
 def generate_figure_latex(image_paths: List[str], work_dir: str) -> str:
     """
     生成图片的 LaTeX 代码
@@ -203,20 +571,18 @@ def generate_figure_latex(image_paths: List[str], work_dir: str) -> str:
         LaTeX 代码
     """
     latex_parts = []
+    work = PurePath(work_dir)
     
-    for i, img_path in enumerate(image_paths):
-        # 使用相对路径
-        rel_path = os.path.relpath(img_path, work_dir).replace('\\', '/')
-        filename = os.path.splitext(os.path.basename(img_path))[0]
+    for img in map(PurePath, image_paths):
+        # 使用相对路径（图片不在工作目录下时退回 relpath）
+        try:
+            rel_path = img.relative_to(work).as_posix()
+        except ValueError:
+            rel_path = os.path.relpath(img, work_dir).replace('\\', '/')
         
-        # 生成标题
-        title = filename.replace('_', ' ').title()
+        # 由文件名生成标题
+        title = img.stem.replace('_', ' ').title()
         
-        latex_parts.append(f"""\\begin{{figure}}[H]
-    \\centering
-    \\includegraphics[width=0.8\\textwidth]{{{rel_path}}}
-    \\caption{{{title}}}
-\\end{{figure}}
-""")
+        latex_parts.append(_FIG_TEMPLATE.format(rel_path, title))
     
     return '\n'.join(latex_parts)
@@ -4,14 +4,41 @@ AI 报告生成器模块
 """
 
 import os
+import re
 import json
 import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Callable, Iterator
 from abc import ABC, abstractmethod
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+# clean_content 使用的正则：```latex ... ``` 代码块、单独的 ``` 标记行、中文字符
+_LATEX_BLOCK_RE = re.compile(r'```(?:latex)?\s*(.*?)\s*```', re.DOTALL | re.IGNORECASE)
+_FENCE_LINE_RE = re.compile(r'^[^\S\n]*```[^\n]*(?:\n|\Z)', re.MULTILINE)
+_CJK_RE = re.compile('[\u4e00-\u9fff]')
+
+# 第 1 部分中“实验步骤”标题：流式生成时出现该标题即说明实验原理已经完整
+_STEPS_SECTION_RE = re.compile(r'\\section\*?\{\s*实验步骤\s*\}')
+# 标题可能被拆在两个分块之间，每次从新分块前这么多字符处开始查找
+_STEPS_SECTION_MAX_LEN = 32
+
+# 同时处理图片的线程数（PIL 解码、缩放与编码时释放 GIL）
+IMAGE_WORKERS = 8
+
 
 def resize_image_for_api(image_path, max_size=1024):
     """
@@ -39,6 +66,65 @@ def resize_image_for_api(image_path, max_size=1024):
             return f.read()
 
 
+def _create_http_session() -> requests.Session:
+    """
+    创建所有后端共用的 HTTP 会话
+    
+    连接池按主机保存 keep-alive 连接，不同配置的后端访问同一 API 地址时也能复用，
+    只需一次 DNS 查询与 TLS 握手。仅在建立连接失败时重试，不会重复提交生成请求。
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, read=0, status=0, backoff_factor=0.2)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_SHARED_SESSION = _create_http_session()
+
+
+def _dumps(data: Dict) -> bytes:
+    """将请求体编码为 UTF-8 JSON（优先使用 orjson，含大量 base64 图片时明显更快）"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def _loads(data: bytes):
+    """解析 UTF-8 JSON 响应"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@lru_cache(maxsize=64)
+def _encode_image_cached(image_path, mtime_ns, max_size):
+    """缩放并编码为 base64 的图片，mtime_ns 只用于在文件变化后使缓存失效"""
+    return base64.b64encode(resize_image_for_api(image_path, max_size)).decode()
+
+
+def encode_image_for_api(image_path, max_size=1024) -> str:
+    """
+    缩放图片并返回 base64 编码的 JPEG 数据
+    
+    结果按 (路径, 修改时间, 尺寸) 缓存，分步生成与重试时同一张图片只解码、缩放、编码一次
+    """
+    return _encode_image_cached(image_path, os.stat(image_path).st_mtime_ns, max_size)
+
+
+def encode_images_for_api(images: Optional[List[str]]) -> List[str]:
+    """并发处理多张图片，返回 base64 编码的 JPEG 数据（按原顺序，跳过不存在的文件）"""
+    paths = [p for p in images or [] if os.path.exists(p)]
+    if len(paths) <= 1:
+        return [encode_image_for_api(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=min(IMAGE_WORKERS, len(paths))) as pool:
+        return list(pool.map(encode_image_for_api, paths))
+
+
 class AIBackend(ABC):
     """AI 后端抽象基类"""
     
@@ -49,20 +135,12 @@ class AIBackend(ABC):
             return ""
             
         # 1. 尝试直接提取 ```latex ... ``` 之间的内容
-        import re
-        code_block_match = re.search(r'```(?:latex)?\s*(.*?)\s*```', content, re.DOTALL | re.IGNORECASE)
+        code_block_match = _LATEX_BLOCK_RE.search(content)
         if code_block_match:
             content = code_block_match.group(1)
         else:
-            # 2. 如果没找到代码块，则通过行过滤掉 ``` 标记
-            lines = content.split('\n')
-            clean_lines = []
-            for line in lines:
-                stripped = line.strip()
-                if stripped.startswith('```'):
-                    continue
-                clean_lines.append(line)
-            content = '\n'.join(clean_lines)
+            # 2. 如果没找到代码块，则过滤掉以 ``` 开头的行
+            content = _FENCE_LINE_RE.sub('', content)
         
         # 3. 移除常见的前言废话 (如 "好的，这是生成的...")
         # 如果第一行不是 \section, \subsection, \item 等 LaTeX 命令，尝试寻找第一个 LaTeX 命令的位置
@@ -71,10 +149,14 @@ class AIBackend(ABC):
         if first_slash > 0 and first_slash < 200: # 如果前面有不到 200 字的废话
             # 检查废话里是否包含中文字符，如果包含且没有反斜杠，很有可能是前言
             prefix = content[:first_slash]
-            if any('\u4e00' <= char <= '\u9fff' for char in prefix):
+            if _CJK_RE.search(prefix):
                 content = content[first_slash:]
         
         return content.strip()
+    
+    def generate_stream(self, prompt: str, images: List[str] = None) -> Iterator[str]:
+        """逐段返回生成内容；不支持流式输出的后端一次性返回全部内容"""
+        yield self.generate(prompt, images)
 
 
 class OpenAIBackend(AIBackend):
@@ -84,8 +166,11 @@ class OpenAIBackend(AIBackend):
         self.api_key = api_key
         self.api_url = api_url
         self.model = model
+        # 使用模块级共享会话复用 HTTPS 连接（keep-alive）
+        self.session = _SHARED_SESSION
     
-    def generate(self, prompt: str, images: List[str] = None) -> str:
+    def _build_request(self, prompt: str, images: List[str] = None):
+        """构造请求头与请求体"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -94,29 +179,49 @@ class OpenAIBackend(AIBackend):
         messages = [{"role": "user", "content": []}]
         messages[0]["content"].append({"type": "text", "text": prompt})
         
-        if images:
-            for img_path in images:
-                if os.path.exists(img_path):
-                    img_data_bytes = resize_image_for_api(img_path)
-                    img_data = base64.b64encode(img_data_bytes).decode()
-                    messages[0]["content"].append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img_data}"}
-                    })
+        for img_data in encode_images_for_api(images):
+            messages[0]["content"].append({
+                "type": "image_url",
+                "image_url": {"url": f"data:image/jpeg;base64,{img_data}"}
+            })
         
         data = {
             "model": self.model,
             "messages": messages,
             "max_tokens": 32768
         }
+        return headers, data
+    
+    def generate(self, prompt: str, images: List[str] = None) -> str:
+        headers, data = self._build_request(prompt, images)
         
-        response = requests.post(self.api_url, headers=headers, json=data, timeout=300)
+        response = self.session.post(self.api_url, headers=headers, data=_dumps(data), timeout=300)
         response.raise_for_status()
         
-        result = response.json()
+        result = _loads(response.content)
         content = result["choices"][0]["message"]["content"]
         # 后端不再自动清理，由调用方决定何时清理
         return content
+    
+    def generate_stream(self, prompt: str, images: List[str] = None) -> Iterator[str]:
+        """以 stream=True 请求，按 Server-Sent Events 逐段返回生成内容"""
+        headers, data = self._build_request(prompt, images)
+        data["stream"] = True
+        
+        with self.session.post(self.api_url, headers=headers, data=_dumps(data), timeout=300, stream=True) as response:
+            response.raise_for_status()
+            # text/event-stream 响应常不带 charset，requests 会按 ISO-8859-1 解码，这里按字节读取后以 UTF-8 解析
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    break
+                choices = _loads(payload).get("choices") or []
+                if choices:
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta:
+                        yield delta
 
 
 class OllamaBackend(AIBackend):
@@ -125,23 +230,19 @@ class OllamaBackend(AIBackend):
     def __init__(self, base_url: str = "http://localhost:11434", model: str = "llama3"):
         self.base_url = base_url
         self.model = model
+        self.session = _SHARED_SESSION
     
     def generate(self, prompt: str, images: List[str] = None) -> str:
         url = f"{self.base_url}/api/generate"
         data = {"model": self.model, "prompt": prompt, "stream": False}
         
         if images:
-            data["images"] = []
-            for img_path in images:
-                if os.path.exists(img_path):
-                    img_data_bytes = resize_image_for_api(img_path)
-                    img_data = base64.b64encode(img_data_bytes).decode()
-                    data["images"].append(img_data)
+            data["images"] = encode_images_for_api(images)
         
-        response = requests.post(url, json=data, timeout=300)
+        response = self.session.post(url, headers={"Content-Type": "application/json"}, data=_dumps(data), timeout=300)
         response.raise_for_status()
         
-        result = response.json()
+        result = _loads(response.content)
         return result.get("response", "")
 
 
@@ -206,7 +307,8 @@ class ReportGenerator:
     def generate_report_content(self,
                                 experiment_guide: str = None,
                                 data_sheet_images: List[str] = None,
-                                additional_requirements: str = None) -> str:
+                                additional_requirements: str = None,
+                                on_data_ready: Optional[Callable[[str], None]] = None) -> str:
         """
         生成完整的报告内容（分步生成机制）
         
@@ -214,25 +316,53 @@ class ReportGenerator:
             experiment_guide: 实验指导书内容（文本）
             data_sheet_images: 数据记录表图片路径列表
             additional_requirements: 额外要求
+            on_data_ready: 第 2 步（数据处理部分）完成后立即调用的回调，参数为前两部分内容，
+                调用方可借此提前发起依赖数据表格的请求（如画图代码），与第 3 步并行
             
         Returns:
             合成的完整 LaTeX 报告内容
         """
         print("开始分步生成报告...")
         
-        # 1. 生成基础部分 (目的、器材、原理、步骤)
+        # 1. 生成基础部分 (目的、器材、原理、步骤)，以流式方式接收
         print("Step 1: 生成基础部分...")
         part1_prompt = self._build_part1_prompt(experiment_guide, additional_requirements)
-        part1_raw = self.backend.generate(part1_prompt)
-        part1_content = self.backend.clean_content(part1_raw)
-        print("Step 1 完成")
         
-        # 2. 生成数据处理部分 (结果与数据处理) - 需要传图
-        print("Step 2: 生成数据处理部分...")
-        part2_prompt = self._build_part2_prompt(part1_content, additional_requirements)
-        part2_raw = self.backend.generate(part2_prompt, data_sheet_images)
-        part2_content = self.backend.clean_content(part2_raw)
-        print("Step 2 完成")
+        def generate_part2(previous_context):
+            # 2. 生成数据处理部分 (结果与数据处理) - 需要传图
+            print("Step 2: 生成数据处理部分...")
+            part2_prompt = self._build_part2_prompt(previous_context, additional_requirements)
+            part2_raw = self.backend.generate(part2_prompt, data_sheet_images)
+            print("Step 2 完成")
+            return self.backend.clean_content(part2_raw)
+        
+        # 第 2 步需要第 1 步定义的公式与符号：第 1 步输出到“实验步骤”标题时，
+        # 实验原理已经完整，此时即发出第 2 步请求，与第 1 步剩余部分（实验步骤）的生成重叠
+        pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            part2_future = None
+            part1_raw = ''
+            for chunk in self.backend.generate_stream(part1_prompt):
+                search_from = max(0, len(part1_raw) - _STEPS_SECTION_MAX_LEN)
+                part1_raw += chunk
+                if part2_future is None:
+                    match = _STEPS_SECTION_RE.search(part1_raw, search_from)
+                    if match:
+                        principle_context = self.backend.clean_content(part1_raw[:match.start()])
+                        part2_future = pool.submit(generate_part2, principle_context)
+            part1_content = self.backend.clean_content(part1_raw)
+            print("Step 1 完成")
+            
+            # 未找到“实验步骤”标题（或后端不支持流式输出）时，等第 1 步全部完成后再开始第 2 步
+            if part2_future is None:
+                part2_future = pool.submit(generate_part2, part1_content)
+            part2_content = part2_future.result()
+        finally:
+            # 第 1 步中途失败时不等待已发出的第 2 步请求
+            pool.shutdown(wait=False)
+        
+        if on_data_ready:
+            on_data_ready(f"{part1_content}\n\n{part2_content}")
         
         # 3. 生成分析与总结 (思考题、总结)
         print("Step 3: 生成分析与总结...")
@@ -330,6 +460,37 @@ class ReportGenerator:
         return self.backend.generate(prompt)
 
 
+# OpenAI 后端实例池：相同 (地址, 密钥, 模型) 复用同一实例（连接由共享会话统一管理）
+_BACKEND_POOL_SIZE = 8
+_backend_pool: 'OrderedDict[tuple, OpenAIBackend]' = OrderedDict()
+_backend_pool_lock = threading.Lock()
+
+
+def get_openai_backend(api_url: str, api_key: str, model: str) -> OpenAIBackend:
+    """
+    获取 OpenAI 后端（按配置缓存，连接在多次请求间复用）
+    
+    Args:
+        api_url: API 地址
+        api_key: API 密钥
+        model: 模型名称
+        
+    Returns:
+        OpenAIBackend 实例
+    """
+    key = (api_url, api_key, model)
+    with _backend_pool_lock:
+        backend = _backend_pool.get(key)
+        if backend is None:
+            backend = OpenAIBackend(api_key=api_key, api_url=api_url, model=model)
+            _backend_pool[key] = backend
+            if len(_backend_pool) > _BACKEND_POOL_SIZE:
+                _backend_pool.popitem(last=False)
+        else:
+            _backend_pool.move_to_end(key)
+        return backend
+
+
 def create_generator(backend_type: str = "mock", **kwargs) -> ReportGenerator:
     """
     创建报告生成器
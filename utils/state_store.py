@@ -0,0 +1,302 @@
+"""
+状态存储模块
+保存会话与任务状态：默认存放在进程内存中；配置 Redis 后存放在 Redis，
+多个服务进程可以共享状态，服务重启后状态也不会丢失
+
+存储同时提供简单的变更通知（publish/subscribe），用于向前端推送任务进度
+"""
+
+import copy
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+
+class MemoryStore:
+    """
+    进程内存储（默认），数据随进程退出而丢失
+
+    记录在最后一次写入 ttl 秒后过期；记录数超过 max_entries 时淘汰最久未写入的记录
+    """
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        """
+        初始化存储
+
+        Args:
+            ttl: 记录有效期（秒），None 表示不过期
+            max_entries: 最多保留的记录数，None 表示不限制
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 按最后写入时间排序：键 -> (过期时间, 记录)
+        self._data: 'OrderedDict[str, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self._lock = threading.RLock()
+        self._versions: Dict[str, int] = {}
+        self._changed = threading.Condition()
+
+    def _purge(self):
+        """清理过期与超出容量的记录（调用方需持有锁）"""
+        now = time.monotonic()
+        removed = []
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now and (self.max_entries is None or len(self._data) <= self.max_entries):
+                break
+            self._data.popitem(last=False)
+            removed.append(key)
+        if removed:
+            with self._changed:
+                for key in removed:
+                    self._versions.pop(key, None)
+
+    def _lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """返回未过期的记录（调用方需持有锁）"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._purge()
+            return None
+        return entry[1]
+
+    def _store(self, key: str, value: Dict[str, Any]):
+        """写入记录并刷新有效期（调用方需持有锁）"""
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float('inf')
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        self._purge()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取记录（返回副本，修改后需通过 set/update/modify 写回）"""
+        with self._lock:
+            value = self._lookup(key)
+            return copy.deepcopy(value) if value is not None else None
+
+    def set(self, key: str, value: Dict[str, Any]):
+        """整体替换记录"""
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._store(key, value)
+
+    def update(self, key: str, fields: Dict[str, Any]):
+        """更新记录的部分字段，记录不存在时创建"""
+        fields = copy.deepcopy(fields)
+        with self._lock:
+            value = self._lookup(key) or {}
+            value.update(fields)
+            self._store(key, value)
+
+    def modify(self, key: str, func: Callable[[Dict[str, Any]], Dict[str, Any]]):
+        """
+        原子地读取-修改-写回记录
+
+        Args:
+            key: 记录键
+            func: 接收记录副本（不存在时为空字典），返回新的记录
+        """
+        with self._lock:
+            value = copy.deepcopy(self._lookup(key) or {})
+            self._store(key, func(value))
+
+    def delete(self, key: str) -> bool:
+        """删除记录"""
+        with self._lock:
+            found = self._lookup(key) is not None
+            self._data.pop(key, None)
+        with self._changed:
+            self._versions.pop(key, None)
+        return found
+
+    def exists(self, key: str) -> bool:
+        """记录是否存在"""
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def publish(self, channel: str):
+        """通知该频道的订阅者有新变更"""
+        with self._changed:
+            self._versions[channel] = self._versions.get(channel, 0) + 1
+            self._changed.notify_all()
+
+    def subscribe(self, channel: str) -> 'MemorySubscription':
+        """订阅频道的变更通知"""
+        return MemorySubscription(self, channel)
+
+
+class MemorySubscription:
+    """进程内订阅：通过条件变量等待频道版本号变化"""
+
+    def __init__(self, store: MemoryStore, channel: str):
+        self.store = store
+        self.channel = channel
+        with store._changed:
+            self._seen = store._versions.get(channel, 0)
+
+    def wait(self, timeout: float) -> bool:
+        """等待下一次变更，超时返回 False"""
+        cond = self.store._changed
+        with cond:
+            changed = cond.wait_for(
+                lambda: self.store._versions.get(self.channel, 0) != self._seen, timeout
+            )
+            self._seen = self.store._versions.get(self.channel, 0)
+        return changed
+
+    def close(self):
+        pass
+
+
+class RedisStore:
+    """Redis 存储：每条记录是一个哈希，每个字段的值以 JSON 编码"""
+
+    def __init__(self, client, ttl: Optional[int] = None):
+        """
+        初始化存储
+
+        Args:
+            client: redis.Redis 实例（需设置 decode_responses=True）
+            ttl: 记录有效期（秒），每次写入后重新计时，None 表示不过期
+        """
+        self.client = client
+        self.ttl = ttl
+
+    def _expire(self, pipe, key: str):
+        if self.ttl is not None:
+            pipe.expire(key, self.ttl)
+
+    @staticmethod
+    def _encode(fields: Dict[str, Any]) -> Dict[str, str]:
+        return {k: json.dumps(v, ensure_ascii=False) for k, v in fields.items()}
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = self.client.hgetall(key)
+        if not raw:
+            return None
+        return {k: json.loads(v) for k, v in raw.items()}
+
+    def set(self, key: str, value: Dict[str, Any]):
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        if value:
+            pipe.hset(key, mapping=self._encode(value))
+            self._expire(pipe, key)
+        pipe.execute()
+
+    def update(self, key: str, fields: Dict[str, Any]):
+        if fields:
+            pipe = self.client.pipeline()
+            pipe.hset(key, mapping=self._encode(fields))
+            self._expire(pipe, key)
+            pipe.execute()
+
+    def modify(self, key: str, func: Callable[[Dict[str, Any]], Dict[str, Any]]):
+        # WATCH/MULTI 乐观事务：期间记录被其他请求修改时自动重试
+        def transaction(pipe):
+            raw = pipe.hgetall(key)
+            value = func({k: json.loads(v) for k, v in raw.items()})
+            pipe.multi()
+            pipe.delete(key)
+            if value:
+                pipe.hset(key, mapping=self._encode(value))
+                self._expire(pipe, key)
+
+        self.client.transaction(transaction, key)
+
+    def delete(self, key: str) -> bool:
+        return bool(self.client.delete(key))
+
+    def exists(self, key: str) -> bool:
+        return bool(self.client.exists(key))
+
+    def publish(self, channel: str):
+        self.client.publish(channel, '1')
+
+    def subscribe(self, channel: str) -> 'RedisSubscription':
+        return RedisSubscription(self.client, channel)
+
+
+class RedisSubscription:
+    """Redis pub/sub 订阅，可接收其他服务进程发布的变更"""
+
+    def __init__(self, client, channel: str):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def wait(self, timeout: float) -> bool:
+        """等待下一条消息，超时返回 False"""
+        # 订阅确认等控制消息也会让 get_message 提前返回 None，因此按截止时间循环等待
+        deadline = time.monotonic() + timeout
+        changed = False
+        while not changed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            changed = self.pubsub.get_message(timeout=remaining) is not None
+        # 合并已积压的消息，调用方只需重新读取一次最新状态
+        while self.pubsub.get_message(timeout=0) is not None:
+            pass
+        return changed
+
+    def close(self):
+        self.pubsub.close()
+
+
+class StoreNamespace:
+    """为存储中的键加上统一前缀（如 session:<id>、task:<id>）"""
+
+    def __init__(self, store, prefix: str):
+        self.store = store
+        self.prefix = prefix
+
+    def get(self, item_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(self.prefix + item_id)
+
+    def set(self, item_id: str, value: Dict[str, Any]):
+        self.store.set(self.prefix + item_id, value)
+
+    def update(self, item_id: str, fields: Dict[str, Any]):
+        self.store.update(self.prefix + item_id, fields)
+
+    def modify(self, item_id: str, func: Callable[[Dict[str, Any]], Dict[str, Any]]):
+        self.store.modify(self.prefix + item_id, func)
+
+    def delete(self, item_id: str) -> bool:
+        return self.store.delete(self.prefix + item_id)
+
+    def __contains__(self, item_id: str) -> bool:
+        return self.store.exists(self.prefix + item_id)
+
+
+def create_store(redis_url: str = None, ttl: Optional[int] = None, max_entries: Optional[int] = None):
+    """
+    创建状态存储
+
+    Args:
+        redis_url: Redis 连接地址（如 redis://localhost:6379/0），为空则使用进程内存储
+        ttl: 记录有效期（秒），None 表示不过期
+        max_entries: 进程内存储最多保留的记录数（Redis 由其自身的内存策略管理）
+
+    Returns:
+        RedisStore 或 MemoryStore 实例
+    """
+    if redis_url:
+        if not REDIS_AVAILABLE:
+            print("redis 未安装，会话与任务状态将保存在内存中")
+        else:
+            try:
+                client = redis.Redis.from_url(redis_url, decode_responses=True)
+                client.ping()
+                return RedisStore(client, ttl=ttl)
+            except Exception as e:
+                print(f"无法连接 Redis ({e})，会话与任务状态将保存在内存中")
+
+    return MemoryStore(ttl=ttl, max_entries=max_entries)
@@ -5,10 +5,31 @@ LaTeX 模板处理器
 
 import os
 import re
+from functools import lru_cache
 from typing import Dict, Any, Optional
 from datetime import datetime
 
 
+@lru_cache(maxsize=8)
+def _read_template(path: str, mtime_ns: int) -> str:
+    """读取模板文件（按路径与修改时间缓存，文件变化后自动重新读取）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+# 需要转义的 LaTeX 特殊字符（前面已有反斜杠的视为已转义，跳过）
+_ESCAPE_RE = re.compile(r'(?<!\\)([&%#_])')
+_ESCAPE_MAP = {
+    '&': r'\&',
+    '%': r'\%',
+    '#': r'\#',
+    '_': r'\_',
+}
+
+# 内容区块: % BEGIN:section_name ... % END:section_name
+_BLOCK_RE = re.compile(r'(% BEGIN:(\w+))(.*?)(% END:\2)', re.DOTALL)
+
+
 class TemplateProcessor:
     """LaTeX 模板处理器"""
     
@@ -28,6 +49,12 @@ class TemplateProcessor:
         'is_makeup': 'others'
     }
     
+    # 每个变量对应的 \newcommand{\varName}{...} 匹配模式，类加载时编译一次
+    _VAR_PATTERNS = {
+        key: re.compile(rf'(\\newcommand{{\\{latex_var}}}{{)[^}}]*(}})')
+        for key, latex_var in VARIABLE_MAP.items()
+    }
+    
     def __init__(self, template_path: str):
         """
         初始化处理器
@@ -41,9 +68,11 @@ class TemplateProcessor:
     
     def _load_template(self):
         """加载模板文件"""
-        if os.path.exists(self.template_path):
-            with open(self.template_path, 'r', encoding='utf-8') as f:
-                self.template_content = f.read()
+        try:
+            mtime_ns = os.stat(self.template_path).st_mtime_ns
+        except OSError:
+            return
+        self.template_content = _read_template(self.template_path, mtime_ns)
     
     def process(self, data: Dict[str, Any]) -> str:
         """
@@ -61,17 +90,16 @@ class TemplateProcessor:
         content = self.template_content
         
         # 替换 LaTeX newcommand 定义
-        for key, latex_var in self.VARIABLE_MAP.items():
+        for key in self.VARIABLE_MAP:
             if key in data:
                 value = str(data[key])
                 # 转义 LaTeX 特殊字符（除非是已转义的LaTeX命令）
                 if not value.startswith('$') and not value.startswith('\\'):
                     value = self._escape_latex(value)
-                # 转义 replacement 中的反斜杠，避免 regex 错误
-                value_escaped = value.replace('\\', '\\\\')
-                # 替换 \newcommand{\varName}{...}
-                pattern = rf'(\\newcommand{{\\{latex_var}}}{{)[^}}]*(}})'
-                content = re.sub(pattern, rf'\g<1>{value_escaped}\g<2>', content)
+                # 替换 \newcommand{\varName}{...}（函数形式的 replacement 不解析反斜杠）
+                content = self._VAR_PATTERNS[key].sub(
+                    lambda m, value=value: m.group(1) + value + m.group(2), content
+                )
         
         # 替换内容区块
         if 'sections' in data:
@@ -85,30 +113,19 @@ class TemplateProcessor:
         if text.startswith('$') or text.startswith('\\'):
             return text
         
-        # 转义特殊字符
-        replacements = {
-            '&': r'\&',
-            '%': r'\%',
-            '#': r'\#',
-            '_': r'\_',
-        }
-        
-        for char, escaped in replacements.items():
-            # 避免重复转义
-            if escaped not in text:
-                text = text.replace(char, escaped)
-        
-        return text
+        # 一次扫描完成全部转义
+        return _ESCAPE_RE.sub(lambda m: _ESCAPE_MAP[m.group(1)], text)
     
     def _replace_sections(self, content: str, sections: Dict[str, str]) -> str:
         """替换内容区块"""
-        # 区块标记格式: % BEGIN:section_name ... % END:section_name
-        for section_name, section_content in sections.items():
-            pattern = rf'(% BEGIN:{section_name})(.*?)(% END:{section_name})'
-            replacement = rf'\g<1>\n{section_content}\n\g<3>'
-            content = re.sub(pattern, replacement, content, flags=re.DOTALL)
-        
-        return content
+        # 一次扫描替换所有区块，未提供内容的区块保持原样
+        def replace_block(match):
+            section_name = match.group(2)
+            if section_name not in sections:
+                return match.group(0)
+            return f"{match.group(1)}\n{sections[section_name]}\n{match.group(4)}"
+        
+        return _BLOCK_RE.sub(replace_block, content)
     
     def generate_report(self, 
                        student_info: Dict[str, str],